@@ -0,0 +1,361 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+# resource is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+
+# SID finds its backends in ./modules, so it is imported from the root of the repository
+os.chdir(ROOT)
+sys.path.insert(0, str(ROOT))
+from modules.worker import *
+from modules.helper_general import settings
+from modules.helper_cache import open_cache, zstandard
+from modules.helper_osis import check_osis
+from corpus import load_corpus, VERSIONS
+
+##################################################################
+##################################################################
+# Benchmarks of the stages of a build
+#
+# A module is built from the frozen corpus (see corpus.py) for each
+# backend, stage by stage, and every stage is timed on its own:
+#
+#   cache read   reading the pages from the pack cache
+#   parse        parsing the pages into chapters (parseChapter, parseBookData)
+#   create_osis  writing the OSIS file
+#   notes        rendering the cross references and footnotes on their
+#                own (make_xref, make_footnote), which is part of create_osis
+#   validate     checking the structure of the OSIS file (check_osis)
+#   compile      building the module with osis2mod (a stand-in, see bin/osis2mod)
+#   zip          packing the ZIP file of the module
+#
+# Everything runs in this process, nothing is downloaded, and the caches
+# of earlier runs are not used. So the results are the work per core of
+# a build with a warm page cache. Every stage is run a few times, the
+# fastest run counts. For every stage, the peak RSS of the process and
+# the peak of the memory allocated by the stage are measured as well.
+#
+# The results are compared with a baseline (baseline.json), a stage is
+# reported as a regression if it got slower or needs more memory than
+# the tolerance allows. The digest of the OSIS file is compared too, it
+# only changes if the output of SID does. The baseline is saved with
+# --save-baseline, on the machine the benchmarks run on.
+
+STAGES = ["cache read", "parse", "create_osis", "notes", "validate", "compile", "zip"]
+
+# differences smaller than these are noise
+MIN_SECONDS = 0.005
+MIN_MB = 2.0
+
+##################################################################
+##################################################################
+# memory measurements
+
+# The peak RSS of the process in MB. On Linux it can be reset, so it is measured for every stage on its own.
+# Elsewhere, it is the peak since the process started.
+def peak_rss():
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return 0.0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / (1 << 20) if sys.platform == "darwin" else maxrss / 1024
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+##################################################################
+##################################################################
+# the stages
+
+class Build:
+
+    def __init__(self, backend, workdir):
+
+        corpus = load_corpus(backend)
+        self.backend = backend
+        self.version = corpus['version']
+        self.pages = [(book, chapter) for book, chapter, page in corpus['pages']]
+        self.name = f"{self.version}_{backend}"
+        self.build_dir = workdir / "build_temp" / self.name
+        self.osis_path = workdir / f"{self.name}.osis.xml"
+        self.zip_path = workdir / f"{self.name}.zip"
+
+        # the pages go into the cache like downloaded ones
+        self.store = open_cache(backend, self.version, load_backend(backend).CACHE_LAYOUT)
+        for book, chapter, page in corpus['pages']:
+            self.store.put(book, chapter, page.encode())
+
+        # the version of osis2mod is only asked for once, not in the first compile stage
+        osis2mod_version()
+
+    def read_pages(self):
+        return [self.store.get(book, chapter) for book, chapter in self.pages]
+
+    def parse(self, pages):
+
+        if self.backend == "aolab":
+            import modules.backend_aolab as aolab
+            return [{"book": book, "chapter": chapter, "content": aolab.parseChapter(json.loads(page), book, chapter)}
+                    for (book, chapter), page in zip(self.pages, pages)]
+
+        import modules.backend_biblegateway as biblegateway
+        return [{"book": book, "chapter": chapter, "content": biblegateway.parseBookData(page.decode(), book, [chapter], self.version, settings["html_parser"])[0]}
+                for (book, chapter), page in zip(self.pages, pages)]
+
+    def create_osis(self, chapters):
+        create_osis(iter(chapters), self.name, self.osis_path, False)
+        return file_digest(self.osis_path)
+
+    # the markers of all chapters, rendered like create_osis does it
+    def notes(self, chapters):
+
+        xref_target.cache_clear()
+        notes = []
+        for chapter in chapters:
+            state = MarkerState()
+            for kind, value in zip(chapter.kinds, chapter.values):
+                if kind == XREF:
+                    notes.append(make_xref(escape_xml(value), state))
+                elif kind == FOOTNOTE:
+                    notes.append(make_footnote(escape_xml(value), state))
+        return notes
+
+    def validate(self):
+
+        errors = check_osis(self.osis_path)
+        if errors:
+            raise ValueError(f"The OSIS file of {self.name} has {len(errors)} structure errors, e.g. {errors[0]}")
+
+    def compile(self):
+        build_and_install(self.name, self.name, "en", self.osis_path, self.name, "SID", False, self.build_dir)
+
+    def zip(self):
+        with open(self.zip_path, "wb") as f:
+            create_zip_module(self.name, self.build_dir, False, False, fileobj=f)
+
+    # all stages in their order, each of them is run by measure(stage, function, arguments)
+    def run(self, measure):
+
+        pages = measure("cache read", self.read_pages)
+        chapters = measure("parse", self.parse, pages)
+        output = measure("create_osis", self.create_osis, chapters)
+
+        compact = [Chapter.from_entry(chapter) for chapter in chapters]
+        measure("notes", self.notes, compact)
+
+        measure("validate", self.validate)
+
+        # a module compiled in an earlier run would be used instead of compiling it again
+        shutil.rmtree(compiled_path("module").parent, ignore_errors=True)
+        measure("compile", self.compile)
+        measure("zip", self.zip)
+
+        return output
+
+##################################################################
+##################################################################
+# run the stages of a backend
+
+def benchmark(backend, rounds, workdir):
+
+    build = Build(backend, workdir)
+    results = {stage: {"seconds": None, "rss_mb": 0.0, "alloc_mb": 0.0} for stage in STAGES}
+
+    def timed(stage, function, *args):
+        gc.collect()
+        reset_peak_rss()
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        r = results[stage]
+        r["seconds"] = seconds if r["seconds"] is None else min(r["seconds"], seconds)
+        r["rss_mb"] = max(r["rss_mb"], peak_rss())
+        return result
+
+    # the allocations are traced in a run of their own, tracing makes everything a lot slower
+    def traced(stage, function, *args):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            result = function(*args)
+            results[stage]["alloc_mb"] = (tracemalloc.get_traced_memory()[1] - before) / (1 << 20)
+        finally:
+            tracemalloc.stop()
+        return result
+
+    for _ in range(rounds):
+        output = build.run(timed)
+    build.run(traced)
+
+    chapters = len(build.pages)
+    for stage in STAGES:
+        results[stage]["chapters_per_second"] = chapters / results[stage]["seconds"] if results[stage]["seconds"] else 0.0
+
+    return {"version": build.version, "chapters": chapters, "output": output, "stages": results}
+
+##################################################################
+##################################################################
+# comparison with the baseline
+
+def machine():
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "html_parser": settings["html_parser"],
+            # the cached pages are compressed with zlib without it, which changes how long it takes to read them
+            "zstandard": zstandard is not None}
+
+# the regressions of the results of a backend compared with the baseline, as a list of messages
+def regressions(result, base, tolerance):
+
+    found = []
+    if result["output"] != base.get("output"):
+        found.append("the OSIS file is different")
+
+    for stage in STAGES:
+        now = result["stages"][stage]
+        before = base.get("stages", {}).get(stage)
+        if not before:
+            continue
+        if now["seconds"] > before["seconds"]*(1+tolerance) and now["seconds"] - before["seconds"] > MIN_SECONDS:
+            found.append(f"{stage} takes {now['seconds']/before['seconds']-1:.0%} longer")
+        if now["rss_mb"] > before["rss_mb"]*(1+tolerance) and now["rss_mb"] - before["rss_mb"] > MIN_MB:
+            found.append(f"{stage} has a peak RSS of {now['rss_mb']:.1f} MB instead of {before['rss_mb']:.1f} MB")
+        if now["alloc_mb"] > before["alloc_mb"]*(1+tolerance) and now["alloc_mb"] - before["alloc_mb"] > MIN_MB:
+            found.append(f"{stage} allocates {now['alloc_mb']:.1f} MB instead of {before['alloc_mb']:.1f} MB")
+
+    return found
+
+def print_results(backend, result, base):
+
+    print(f" {backend} ({result['version']}): {result['chapters']} chapters")
+    print(f"   {'stage':<12} {'seconds':>9} {'chapters/s':>11} {'peak RSS MB':>12} {'alloc MB':>9} {'baseline':>9}")
+    for stage in STAGES:
+        r = result["stages"][stage]
+        before = base.get("stages", {}).get(stage) if base else None
+        change = f"{r['seconds']/before['seconds']-1:+.0%}" if before and before["seconds"] else ""
+        print(f"   {stage:<12} {r['seconds']:>9.3f} {r['chapters_per_second']:>11.0f} {r['rss_mb']:>12.1f} {r['alloc_mb']:>9.1f} {change:>9}")
+    print("")
+
+##################################################################
+##################################################################
+
+def main():
+
+    parser = argparse.ArgumentParser(prog='bench', description='Benchmarks of the stages of a SID build on a frozen corpus')
+    parser.add_argument('--backend', default="", help=f"Only benchmark this backend ({", ".join(VERSIONS)}).")
+    parser.add_argument('--rounds', default=5, type=int, help="Number of times every stage is run, the fastest run counts (default: 5).")
+    parser.add_argument('--html-parser', default=settings["html_parser"], choices=["lxml", "bs4"], help="The parser for the HTML pages of biblegateway.")
+    parser.add_argument('--processes', default=settings["processes"], type=int, help=f"Number of threads for compressing the ZIP file (default: {settings['processes']}).")
+    parser.add_argument('--baseline', default=str(BENCH_DIR / "baseline.json"), help="The file with the baseline (default: benchmarks/baseline.json).")
+    parser.add_argument('--save-baseline', default=False, action='store_true', help="Save the results as the new baseline instead of comparing them with it.")
+    parser.add_argument('--tolerance', default=0.25, type=float, help="How much slower (or bigger) a stage can get before it is a regression (default: 0.25, i.e. 25%%).")
+    parser.add_argument('--output', default="", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    if args.backend and args.backend not in VERSIONS:
+        print(f" There is no corpus for the backend '{args.backend}', possible backends are: {", ".join(VERSIONS)}")
+        return 1
+
+    settings["html_parser"] = args.html_parser
+    settings["processes"] = max(1, args.processes)
+    settings["process_pool"] = None
+    settings["progress"] = False
+
+    # the stand-in for osis2mod is found first
+    os.environ["PATH"] = f"{BENCH_DIR / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}"
+
+    baseline = {}
+    if not args.save_baseline:
+        try:
+            baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            print(f" No baseline found at '{args.baseline}', save one with --save-baseline.")
+            print("")
+
+    if baseline and baseline.get("machine") != machine():
+        print(" The baseline was measured on another machine (or with other settings), compare the timings with care:")
+        print(f"   baseline: {baseline.get('machine')}")
+        print(f"   now:      {machine()}")
+        print("")
+
+    # the caches and the build files of the benchmarks go into a directory of their own
+    workdir = Path(tempfile.mkdtemp(prefix="sid-bench."))
+    os.chdir(workdir)
+
+    results = {}
+    try:
+        for backend in ([args.backend] if args.backend else list(VERSIONS)):
+            results[backend] = benchmark(backend, max(1, args.rounds), workdir)
+            print_results(backend, results[backend], baseline.get("results", {}).get(backend))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"machine": machine(), "results": results}
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=1), encoding="utf-8")
+
+    if args.save_baseline:
+        # the results of backends that were not run are kept
+        try:
+            old = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            old = {}
+        report["results"] = {**old.get("results", {}), **results}
+        Path(args.baseline).write_text(json.dumps(report, indent=1), encoding="utf-8")
+        print(f" Saved the baseline to '{args.baseline}'.")
+        return 0
+
+    if not baseline:
+        return 0
+
+    failed = False
+    for backend, result in results.items():
+        base = baseline.get("results", {}).get(backend)
+        if not base:
+            print(f" The baseline has no results for {backend}.")
+            continue
+        found = regressions(result, base, args.tolerance)
+        for message in found:
+            print(f" [Regression] {backend}: {message}")
+        failed = failed or bool(found)
+
+    if not failed:
+        print(" No regressions compared with the baseline.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import gzip
+import html
+import json
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from modules.helper_booknames import convert_bookname_to_osis, convert_bookname_to_usfm
+
+##################################################################
+##################################################################
+# The corpus of the benchmarks
+#
+# The benchmarks work on cached pages, just like a build with a warm
+# cache: the JSON chapters of aolab and the HTML pages of biblegateway.
+# No real bible text is shipped, the pages are made up here from a
+# fixed seed. They have the same structure as the pages of the two
+# sites: headings, sections, poetry, footnotes and cross references.
+#
+# The corpus is written to benchmarks/corpus/ and kept in the repository,
+# so all measurements are made on exactly the same pages. It is only
+# generated again (python benchmarks/corpus.py) if it has to change, and
+# the baseline has to be saved again after that.
+
+CORPUS_DIR = Path(__file__).resolve().parent / "corpus"
+
+# prose with many notes, poetry, and a few short books
+BOOKS = {"Genesis": 50, "Psalms": 150, "Mark": 16, "Jude": 1}
+
+VERSIONS = {"aolab": "BSB", "biblegateway": "KJV"}
+
+WORDS = ("and the of he said unto them lord god his that in for was they all which shall be with not it is "
+         "thou thee thy people land king house son sons day children came went made upon earth heaven man "
+         "men before over brought hand against you me him according word name spake city father brethren "
+         "waters light darkness evening morning behold blessed righteous wicked mercy truth salvation").split()
+
+# the targets of the cross references
+XREF_TARGETS = ["Jeremiah 4:23", "Psalm 33:6", "John 1:1-John 1:3", "Hebrews 11:3", "1 Samuel 2:3",
+                "Genesis 2:4-Genesis 2:7", "Isaiah 45:18", "Romans 1:20", "Mark 1:1", "Revelation 22:13"]
+
+def sentence(rng, length):
+
+    words = [rng.choice(WORDS) for _ in range(length)]
+    words[0] = words[0].capitalize()
+    for i in range(3, length-2, 7):
+        if rng.random() < .5:
+            words[i] += ","
+    if rng.random() < .1:
+        words[-1] = f"“{words[-1]}’s”"
+    return " ".join(words) + rng.choice(".;:.")
+
+def verse_count(rng):
+    return rng.randint(10, 35)
+
+##################################################################
+##################################################################
+# aolab: one JSON document per chapter, like the chapters of the API
+
+def aolab_chapter(book, chapter, rng):
+
+    content = []
+    footnotes = []
+
+    if rng.random() < .5:
+        content.append({"type": "heading", "content": [sentence(rng, 3)[:-1].title()]})
+    if book == "Psalms":
+        content.append({"type": "hebrew_subtitle", "content": [sentence(rng, 6)]})
+
+    for v in range(1, verse_count(rng)+1):
+
+        if book == "Psalms":
+            parts = []
+            for line in range(rng.randint(2, 4)):
+                parts.append({"text": sentence(rng, rng.randint(4, 9)), "poem": 1 + line % 2})
+                if rng.random() < .3:
+                    parts.append({"lineBreak": True})
+        else:
+            parts = [sentence(rng, rng.randint(6, 24))]
+
+        if rng.random() < .25:
+            parts.insert(1, {"noteId": len(footnotes)})
+            footnotes.append({"noteId": len(footnotes), "text": f"Or {sentence(rng, 3)}"})
+            parts.insert(2, sentence(rng, 4))
+
+        content.append({"type": "verse", "number": v, "content": parts})
+
+        if rng.random() < .08:
+            content.append({"type": "line_break"})
+        if rng.random() < .04:
+            content.append({"type": "heading", "content": [sentence(rng, 3)[:-1].title()]})
+
+    page = {"translation": {"id": VERSIONS["aolab"]},
+            "book": {"id": convert_bookname_to_usfm(book)},
+            "chapter": {"number": chapter, "content": content, "footnotes": footnotes}}
+
+    return json.dumps(page, ensure_ascii=False, separators=(",", ":"))
+
+##################################################################
+##################################################################
+# biblegateway: one HTML page per chapter, like the print view of the site
+
+def biblegateway_page(book, chapter, rng):
+
+    version = VERSIONS["biblegateway"]
+    osis = convert_bookname_to_osis(book)
+    footnotes = []
+    crossrefs = []
+    # the ids of the verses run through the whole page
+    text_id = 0
+
+    def note_links(verse):
+
+        links = ""
+        if rng.random() < .2:
+            letter = chr(97 + len(footnotes) % 26)
+            note = f"fen-{version}-{text_id}{letter}"
+            links += f'<sup data-fn="#{note}" class="footnote" data-link="[&lt;a href=&quot;#{note}&quot; title=&quot;See footnote {letter}&quot;&gt;{letter}&lt;/a&gt;]">[<a href="#{note}" title="See footnote {letter}">{letter}</a>]</sup>'
+            footnotes.append(f'<li id="{note}"><a href="#en-{version}-{text_id}" title="Go to {book} {chapter}:{verse}">{book} {chapter}:{verse}</a> <span class="footnote-text">Or <i>{html.escape(sentence(rng, 3))}</i></span></li>')
+        if rng.random() < .25:
+            letter = chr(65 + len(crossrefs) % 26)
+            note = f"cen-{version}-{text_id}{letter}"
+            target = rng.choice(XREF_TARGETS)
+            links += f"<sup class='crossreference' data-cr='#{note}' data-link='(&lt;a href=&quot;#{note}&quot; title=&quot;See cross-reference {letter}&quot;&gt;{letter}&lt;/a&gt;)'>(<a href=\"#{note}\" title=\"See cross-reference {letter}\">{letter}</a>)</sup>"
+            crossrefs.append(f'<li id="{note}"><a href="#en-{version}-{text_id}" title="Go to {book} {chapter}:{verse}">{book} {chapter}:{verse}</a> : <a class="crossref-link" href="/passage/?search={target}&amp;version={version}" data-bibleref="{target}">{target}</a></li>')
+        return links
+
+    def verse_number(verse):
+        if verse == 1:
+            return f'<span class="chapternum">{chapter}&nbsp;</span>'
+        return f'<sup class="versenum">{verse}&nbsp;</sup>'
+
+    blocks = []
+    if rng.random() < .5:
+        text_id += 1
+        blocks.append(f'<h3><span id="en-{version}-{text_id}" class="text {osis}-{chapter}-1">{html.escape(sentence(rng, 3)[:-1].title())}</span></h3>')
+    if book == "Psalms":
+        text_id += 1
+        blocks.append(f'<h4><span id="en-{version}-{text_id}" class="text {osis}-{chapter}-1">{html.escape(sentence(rng, 6))}</span></h4>')
+
+    paragraph = []
+    for v in range(1, verse_count(rng)+1):
+
+        text_id += 1
+
+        if book == "Psalms":
+            lines = [html.escape(sentence(rng, rng.randint(4, 9))) for _ in range(rng.randint(2, 4))]
+            # the first line of a verse holds its number and notes, the others are indented
+            indented = "".join(f'<br /><span class="indent-1"><span class="indent-1-breaks">&nbsp;&nbsp;&nbsp;&nbsp;</span>{line}</span>' for line in lines[1:])
+            selah = ' <span class="selah">Selah</span>' if rng.random() < .05 else ""
+            blocks.append(f'<div class="poetry"><p class="line"><span id="en-{version}-{text_id}" class="text {osis}-{chapter}-{v}">{verse_number(v)}{lines[0]}{note_links(v)}{indented}{selah}</span></p></div>')
+            continue
+
+        text = html.escape(sentence(rng, rng.randint(6, 24)))
+        if rng.random() < .05:
+            text = text.replace(" lord ", ' <span style="font-variant: small-caps" class="small-caps">Lord</span> ', 1)
+        paragraph.append(f'<span id="en-{version}-{text_id}" class="text {osis}-{chapter}-{v}">{verse_number(v)}{text}{note_links(v)}</span> ')
+
+        if rng.random() < .12:
+            blocks.append(f'<p>{"".join(paragraph)}</p>')
+            paragraph = []
+            if rng.random() < .3:
+                text_id += 1
+                blocks.append(f'<h3><span id="en-{version}-{text_id}" class="text {osis}-{chapter}-{v+1}">{html.escape(sentence(rng, 3)[:-1].title())}</span></h3>')
+
+    if paragraph:
+        blocks.append(f'<p>{"".join(paragraph)}</p>')
+
+    if crossrefs:
+        blocks.append(f'<div class="crossrefs hidden"><h4>Cross references</h4><ol>{"".join(crossrefs)}</ol></div>')
+    if footnotes:
+        blocks.append(f'<div class="footnotes"><h4>Footnotes</h4><ol>{"".join(footnotes)}</ol></div>')
+
+    body = "\n".join(blocks)
+
+    return ('<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n'
+            f'<title>{book} {chapter} {version} - Bible Gateway</title>\n'
+            '<link rel="stylesheet" href="/assets/css/print.css">\n</head>\n<body class="bible-print">\n'
+            '<div class="passage-text">\n<div class="passage-content passage-class-0">\n'
+            f'<div class="version-{version} result-text-style-normal text-html">\n'
+            f'<h1 class="passage-display"><div class="bcv"><div class="dropdown-display"><div class="dropdown-display-text">{book} {chapter}</div></div></div>'
+            f'<div class="translation"><div class="dropdown-display"><div class="dropdown-display-text">King James Version</div></div></div></h1>\n'
+            f'{body}\n'
+            f'<a class="full-chap-link" href="/passage/?search={book}%20{chapter}&amp;version={version}" title="View Full Chapter">Read full chapter</a>\n'
+            '</div>\n</div>\n</div>\n<div class="passage-other-trans">in all English translations</div>\n'
+            '<script>window.print && false;</script>\n</body>\n</html>\n')
+
+##################################################################
+##################################################################
+# write the corpus: one gzipped JSON file per backend with its pages
+
+def make_pages(backend):
+
+    page = aolab_chapter if backend == "aolab" else biblegateway_page
+    pages = []
+    for book in BOOKS:
+        for chapter in range(1, BOOKS[book]+1):
+            rng = random.Random(f"{backend}|{book}|{chapter}")
+            pages.append([book, chapter, page(book, chapter, rng)])
+    return pages
+
+def write_corpus():
+
+    CORPUS_DIR.mkdir(exist_ok=True)
+    for backend, version in VERSIONS.items():
+        corpus = {"backend": backend, "version": version, "pages": make_pages(backend)}
+        data = json.dumps(corpus, ensure_ascii=False, indent=0).encode()
+        # no time stamp in the file, the same corpus always gives the same file
+        with gzip.GzipFile(CORPUS_DIR / f"{backend}.json.gz", "wb", compresslevel=9, mtime=0) as f:
+            f.write(data)
+        print(f" {backend}: {len(corpus['pages'])} pages, {len(data)/1e6:.1f} MB")
+
+def load_corpus(backend):
+
+    with gzip.open(CORPUS_DIR / f"{backend}.json.gz", "rb") as f:
+        return json.loads(f.read())
+
+if __name__ == "__main__":
+    write_corpus()
@@ -1,143 +1,402 @@
 from modules.helper_booknames import *
 from modules.helper_general import *
+from modules.helper_cache import *
 import json
+import time
+import functools
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Thread, Lock, Event
+from urllib.error import URLError
+
+# ijson is optional: without it, a whole translation is decoded at once instead of book by book
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+API_URL = "https://bible.helloao.org/api"
+
+# the file name of a chapter in the loose cache layout
+CACHE_LAYOUT = "{book}.{chapter}.json"
+
+# parsed chapters are cached with this stamp, it changes whenever the parser does
+PARSER_STAMP = source_stamp(__file__)
+
+# cached chapters are checked with the server again after this many seconds
+CACHE_TTL = 30*24*3600
+
+# the list of the available versions is updated after this many seconds
+CATALOGUE_TTL = 7*24*3600
+
+# a whole translation is downloaded at once (instead of chapter by chapter) if at least this many chapters are needed
+BULK_MIN_CHAPTERS = 50
+
+# the validators of the download of a whole translation are cached under this book and chapter
+BULK_KEY = ("complete", "all")
+
+# the books by their USFM id, as used in the downloads of whole translations
+USFM_BOOKS = {convert_bookname_to_usfm(book): book for book in bible_books_chapters}
 
 def getDescription():
     return "Supports 1000+ free-to-use bibles, including many (but not all) well-known versions. Tends to include fewer footnotes, cross-references, or section titles compared to other backends."
 
-def getSupportedVersions():
+# all versions, or only the ones of the given language
+def getSupportedVersions(language=None):
 
-    cache_dir = Path("cache/aolab/")
-    cache_dir.mkdir(exist_ok=True)
-    cache_file = cache_dir / "versions.json"
+    return {v['short_name']: [v['english_name'], v['language']] for v in getCatalogue().versions(language)}
 
-    if cache_file.exists():
-        with open(cache_file) as f:
-            data = json.loads(f.read())
-    else:
+# The index of all available versions. It is built from the list of helloao the first time it is needed,
+# and afterwards updated in the background once it is older than CATALOGUE_TTL (see startCatalogueRefresh).
+@functools.lru_cache(maxsize=None)
+def getCatalogue():
+
+    catalogue = open_catalogue("aolab")
 
+    # the list of the versions was cached as a plain file before
+    legacy = Path("cache/aolab/versions.json")
+    if catalogue.count() == 0 and legacy.exists():
+        with open(legacy) as f:
+            catalogue.replace(catalogueEntries(json.loads(f.read())), {"fetched_at": legacy.stat().st_mtime})
+
+    if catalogue.count() == 0:
         print("Requesting online list of available bible versions... please wait.")
+        refreshCatalogue(catalogue)
+
+    elif needs_refresh(catalogue.validators(), CATALOGUE_TTL):
+        if settings["refresh"]:
+            refreshCatalogue(catalogue)
+        else:
+            with outdated_catalogues_lock:
+                outdated_catalogues.add(catalogue)
+
+    return catalogue
 
-        js = get_page("https://bible.helloao.org/api/available_translations.json")
+# the catalogues that are to be updated in the background by the next build
+outdated_catalogues = set()
+outdated_catalogues_lock = Lock()
 
-        with open(cache_file, "w") as f:
-            f.write(js.decode())
+# Update the outdated catalogues in the background. This is only started by a build, once its processes were
+# created: a thread that is running while they are forked could leave them with a lock that is never released.
+def startCatalogueRefresh():
 
-        data = json.loads(js)
+    with outdated_catalogues_lock:
+        catalogues = list(outdated_catalogues)
+        outdated_catalogues.clear()
 
+    for catalogue in catalogues:
+        # it doesn't keep SID running once everything else is done
+        Thread(target=refreshCatalogue, args=(catalogue, True), daemon=True).start()
 
-    ret_data = {}
-    for entry in data['translations']:
-        ret_data[entry['shortName']] = [entry['englishName'], entry['language']]
+def refreshCatalogue(catalogue, background=False):
 
-    return ret_data
+    url = f"{API_URL}/available_translations.json"
+    validators = catalogue.validators() or {}
+
+    try:
+        response = get_response(url, conditional_headers(validators), retry_count=0 if background else 3)
+    except URLError:
+        # the list we have is good enough until the next try
+        if background:
+            return
+        raise
+
+    if response.status == 304:
+        catalogue.touch(validators_of(response, validators))
+    else:
+        catalogue.replace(catalogueEntries(json.loads(response.body)), validators_of(response))
+
+def catalogueEntries(data):
+
+    return [{"short_name": entry['shortName'],
+             "id": entry['id'],
+             "name": entry.get('name'),
+             "english_name": entry['englishName'],
+             "language": entry['language'],
+             "books": entry.get('numberOfBooks'),
+             "chapters": entry.get('totalNumberOfChapters'),
+             "verses": entry.get('totalNumberOfVerses')} for entry in data['translations']]
 
 def getData(version, verbose):
+    return list(iterData(version, verbose))
 
-    return_data = []
+# Yields the chapters one by one as soon as they are available, while the following ones are still being downloaded
+def iterData(version, verbose):
 
     # get version ID
-    ao_version = version
-    cache_file = "cache/aolab/versions.json"
-    with open(cache_file, 'r') as f:
-        data = json.loads(f.read())
-    for entry in data['translations']:
-        if entry['shortName'] == version:
-            ao_version = entry['id']
-
-    printProgressBar(0, 1189+1, prefix='  Progress:'  , length = 40)
+    entry = getCatalogue().get(version)
+    ao_version = entry['id'] if entry else version
+    startCatalogueRefresh()
+
+    store = open_cache("aolab", version, CACHE_LAYOUT)
+    parsed = open_parsed_cache("aolab")
+    digests = store.digests()
+    validators = store.validators()
+    missing = store.missing()
+
+    # only the books (and chapters) this version has are requested
+    plan = planBooks(ao_version, version, entry, verbose)
+    total = sum(plan.values())
+
+    printProgressBar(0, total+1, prefix='  Progress:'  , length = 40)
     progressCounter = 0
 
-    for book in bible_books_chapters:
+    # All chapters that are not cached yet (or need to be checked again) are requested right away: as a
+    # whole translation if many are needed, otherwise chapter by chapter in parallel.
+    # The results are collected below in the canonical order of the books and chapters.
+    pool = ThreadPoolExecutor(max_workers=settings["workers"])
+    downloads = {}
+    # set when the build stops, so a whole translation isn't downloaded for nothing
+    stop = Event()
 
-        if verbose:
-            print(f"# BOOK: {book}")
+    try:
+
+        urls = {}
+        for book in plan:
+
+            usfm_book = convert_bookname_to_usfm(book)
+
+            for chapter in range(1, plan[book]+1):
+
+                # chapters known to be missing upstream are not requested again until that expires
+                if (book, str(chapter)) in missing and not needs_refresh(missing[(book, str(chapter))], CACHE_TTL):
+                    continue
 
-        usfm_book = convert_bookname_to_usfm(book)
+                if (book, str(chapter)) not in digests or needs_refresh(validators.get((book, str(chapter))), CACHE_TTL):
+                    urls[(book, chapter)] = f"{API_URL}/{ao_version}/{usfm_book}/{chapter}.json"
 
-        for chapter in range(1, bible_books_chapters[book]+1):
+        if settings["bulk"] and len(urls) >= BULK_MIN_CHAPTERS:
+            downloads = {key: Future() for key in urls}
+            pool.submit(downloadTranslation, ao_version, store, downloads.copy(), urls, pool, stop, verbose)
+        else:
+            for (book, chapter), url in urls.items():
+                downloads[(book, chapter)] = pool.submit(downloadChapter, url, store, book, chapter, verbose)
 
-            progressCounter += 1
+        for book in plan:
 
             if verbose:
-                print(f"  chapter: {chapter}")
-            else:
-                printProgressBar(progressCounter, 1189+1, prefix='  Progress:', suffix=f' ({book} {chapter})           ', length = 40)
+                print(f"# BOOK: {book}")
 
-            cache_dir = Path(f"cache/aolab/{version}/")
-            cache_dir.mkdir(exist_ok=True)
-            cache_file = cache_dir / f"{book}.{chapter}.json"
+            for chapter in range(1, plan[book]+1):
+
+                progressCounter += 1
 
-            if cache_file.exists():
-                if verbose:
-                    print("    -> found cached file.")
-                with open(cache_file, 'r') as f:
-                    data = json.loads(f.read())
-            else:
-                url = f"https://bible.helloao.org/api/{ao_version}/{usfm_book}/{chapter}.json"
                 if verbose:
-                    print(f"Requesting onlne resource from: {url}")
-                js = get_page(url)
-                with open(cache_file, 'w') as f:
-                    f.write(js.decode())
-                data = json.loads(js)
+                    print(f"  chapter: {chapter}")
+                else:
+                    printProgressBar(progressCounter, total+1, prefix='  Progress:', suffix=f' ({book} {chapter})           ', length = 40)
+
+                # chapters that were parsed before are taken straight from the cache
+                if (book, chapter) in downloads:
+                    js = downloads.pop((book, chapter)).result()
+                    digest = digest_of(js) if js is not None else None
+                elif (book, str(chapter)) in digests:
+                    if verbose:
+                        print("    -> found cached file.")
+                    js = None
+                    digest = digests[(book, str(chapter))]
+                else:
+                    js = digest = None
 
-            cur_data = []
+                # a chapter missing upstream stays empty
+                if digest is None:
+                    if verbose:
+                        print("    -> not available for this version.")
+                    content = []
+                else:
+                    content = parsed.get(digest, f"{PARSER_STAMP}|{book}|{chapter}")
 
-            for verse in data['chapter']['content']:
+                if content is None:
+                    data = json.loads(js if js is not None else store.get(book, chapter))
+                    content = parseChapter(data, book, chapter)
+                    parsed.put(digest, f"{PARSER_STAMP}|{book}|{chapter}", content)
 
-                if verse['type'] == 'line_break':
+                yield {"book" : book,
+                       "chapter" : chapter,
+                       "content" : content}
 
-                    cur_data.append('---')
+    finally:
+        # don't keep downloading if something went wrong
+        stop.set()
+        pool.shutdown(cancel_futures=True)
 
-                elif verse['type'] == 'heading':
+    printProgressBar(total+1, total+1, prefix='  Progress:', suffix=f'                           ', length = 40)
 
-                    cur_data.append(f"## {verse['content'][0]}")
+# Download a single chapter and store it in the cache (or check the cached one with the server).
+# None is returned if the chapter does not exist. This is run in parallel by iterData.
+def downloadChapter(url, store, book, chapter, verbose):
 
-                elif verse['type'] == 'hebrew_subtitle':
+    if verbose:
+        print(f"Requesting onlne resource from: {url}")
 
-                    cur_data.append(f"#### {verse['content'][0]}")
+    return download_page(store, book, chapter, url)
 
-                elif verse['type'] == 'verse':
+# The books of a version with their number of chapters, in canonical order. This is taken from the
+# catalogue for complete bibles, otherwise from the list of books of the version.
+def planBooks(ao_version, version, entry, verbose):
 
-                    vnum = verse['number']
+    plan = load_plan("aolab", version)
+    if plan and not needs_refresh(plan, CACHE_TTL):
+        return plan['books']
 
-                    curversetxt = ""
-                    for part in verse['content']:
+    if entry and entry['books'] == len(bible_books_chapters) and entry['chapters'] == sum(bible_books_chapters.values()):
+        return save_plan("aolab", version, dict(bible_books_chapters))['books']
 
-                        if type(part) == str:
-                            if curversetxt != "":
-                                curversetxt += " "
-                            curversetxt += part
-                        elif type(part) == dict:
-                            if "noteId" in list(part.keys()):
-                                for fn in data['chapter']['footnotes']:
-                                    if fn['noteId'] == part['noteId']:
-                                        curversetxt += f"|||{book}|{chapter}|{fn['text']}|||"
-                            elif "poem" in list(part.keys()):
-                                if curversetxt != "":
-                                    curversetxt += "\n"
-                                curversetxt += f"{'    '*int(part['poem'])}{part['text']}"
-                            elif 'lineBreak' in list(part.keys()):
-                                curversetxt += "\n"
-                            elif "text" in list(part.keys()):
-                                curversetxt += part['text']
-                            else:
-                                print(f"ERROR: Unknown dict of type '{verse['type']}': {part}")
-                        else:
-                            print(f"ERROR: Unknown part type: {type(part)}")
+    url = f"{API_URL}/{ao_version}/books.json"
+    if verbose:
+        print(f"Requesting onlne resource from: {url}")
 
-                    cur_data.append([str(vnum), curversetxt])
+    try:
+        upstream = {b['id']: b['numberOfChapters'] for b in json.loads(get_page(url))['books']}
+    except (URLError, ValueError, KeyError) as e:
+        # without the list, all books are requested like before
+        print(f"WARNING: could not get the list of books of {version} ({e}), requesting all books.")
+        return dict(bible_books_chapters)
 
-                else:
-                    print(f"WARNING: Unknown entry type '{verse['type']}'")
+    books = {}
+    for book in bible_books_chapters:
+        chapters = min(bible_books_chapters[book], upstream.get(convert_bookname_to_usfm(book)) or 0)
+        if chapters > 0:
+            books[book] = chapters
+
+    return save_plan("aolab", version, books)['books']
+
+# Download a whole translation at once and store its chapters in the cache. The given futures (by book
+# and chapter) get the chapters as soon as they are decoded. Chapters that are not in the download
+# (or all remaining ones, if it fails) are requested on their own in the given pool. The download ends
+# early once stop is set.
+def downloadTranslation(ao_version, store, targets, urls, pool, stop, verbose):
+
+    try:
+        readTranslation(f"{API_URL}/{ao_version}/complete.json", store, targets, stop, verbose)
+    except Exception as e:
+        if verbose:
+            print(f"Downloading the whole translation failed ({e}), requesting the chapters on their own.")
+
+    # the build stopped, nobody waits for the chapters anymore
+    if stop.is_set():
+        for target in targets.values():
+            target.cancel()
+        return
+
+    for key, target in targets.items():
+        if not target.done():
+            try:
+                forwardResult(pool.submit(downloadChapter, urls[key], store, key[0], key[1], verbose), target)
+            except RuntimeError as e:
+                # the pool was shut down in the meantime (the build stopped), nobody waits for the chapter anymore
+                target.set_exception(e)
+
+def readTranslation(url, store, targets, stop, verbose):
+
+    validators = store.get_validators(*BULK_KEY) or {}
+
+    if verbose:
+        print(f"Requesting onlne resource from: {url}")
+
+    # not retried: if this fails, the chapters are requested on their own anyway
+    with open_page(url, conditional_headers(validators), retry_count=0) as stream:
+
+        # nothing changed since the last download, so the cached chapters are still up to date
+        if stream.status == 304:
+            for (book, chapter), target in targets.items():
+                js = store.get(book, chapter)
+                if js is not None:
+                    store.touch(book, chapter, {"fetched_at": time.time()})
+                    target.set_result(js)
+            store.touch(*BULK_KEY, validators_of(stream, validators))
+            return
+
+        # the chapters are decoded one book at a time, and the requested ones are cached like the ones downloaded on
+        # their own (the others are either cached and up to date already, or not needed)
+        for book_data in iterBooks(stream):
+            if stop.is_set():
+                return
+            book = USFM_BOOKS.get(book_data['id'])
+            if book is None:
+                continue
+            for item in book_data['chapters']:
+                chapter = item['chapter']['number']
+                if (book, chapter) not in targets:
+                    continue
+                js = json.dumps(item, ensure_ascii=False, separators=(",", ":")).encode()
+                store.put(book, chapter, js, {"fetched_at": time.time()})
+                targets[(book, chapter)].set_result(js)
+
+        store.touch(*BULK_KEY, validators_of(stream))
+
+# the books of a whole translation, decoded from the stream one by one (if ijson is installed)
+def iterBooks(stream):
+
+    if ijson:
+        yield from ijson.items(stream, "books.item", use_float=True)
+    else:
+        yield from json.load(stream)['books']
+
+# hand the result of a future on to another one
+def forwardResult(source, target):
+
+    def forward(source):
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
 
-            return_data.append({"book" : book,
-                                "chapter" : chapter,
-                                "content" : cur_data})
+    source.add_done_callback(forward)
+
+# Convert the json data of one chapter into the list format expected by SID
+def parseChapter(data, book, chapter):
+
+    cur_data = []
+
+    for verse in data['chapter']['content']:
+
+        if verse['type'] == 'line_break':
+
+            cur_data.append('---')
+
+        elif verse['type'] == 'heading':
+
+            cur_data.append(f"## {verse['content'][0]}")
+
+        elif verse['type'] == 'hebrew_subtitle':
+
+            cur_data.append(f"#### {verse['content'][0]}")
+
+        elif verse['type'] == 'verse':
+
+            vnum = verse['number']
+
+            curversetxt = ""
+            for part in verse['content']:
+
+                if type(part) == str:
+                    if curversetxt != "":
+                        curversetxt += " "
+                    curversetxt += part
+                elif type(part) == dict:
+                    if "noteId" in list(part.keys()):
+                        for fn in data['chapter']['footnotes']:
+                            if fn['noteId'] == part['noteId']:
+                                curversetxt += f"|||{book}|{chapter}|{fn['text']}|||"
+                    elif "poem" in list(part.keys()):
+                        if curversetxt != "":
+                            curversetxt += "\n"
+                        curversetxt += f"{'    '*int(part['poem'])}{part['text']}"
+                    elif 'lineBreak' in list(part.keys()):
+                        curversetxt += "\n"
+                    elif "text" in list(part.keys()):
+                        curversetxt += part['text']
+                    else:
+                        print(f"ERROR: Unknown dict of type '{verse['type']}': {part}")
+                else:
+                    print(f"ERROR: Unknown part type: {type(part)}")
 
+            cur_data.append([str(vnum), curversetxt])
 
-    printProgressBar(1189+1, 1189+1, prefix='  Progress:', suffix=f'                           ', length = 40)
+        else:
+            print(f"WARNING: Unknown entry type '{verse['type']}'")
 
-    return return_data;
+    return cur_data
@@ -1,82 +1,263 @@
 from urllib.parse import urlencode
 from bs4 import BeautifulSoup
 from pathlib import Path
+import bs4
+import time
+from html.entities import html5 as html_entities
+from concurrent.futures import ThreadPoolExecutor, Future
 from .helper_booknames import *
 from .helper_general import *
+from .helper_cache import *
+
+# lxml is optional, without it all pages are parsed by BeautifulSoup (a lot slower)
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+SOURCE_URL = "https://www.biblegateway.com/passage/"
+
+# To get a list, the passage separator is given an actual practical use as an indicator of where to split
+# the string to create list elements.
+passage_separator = '-_-'
+
+# When several chapters are requested at once, the start of each chapter is marked in the text like this: -@2-@
+chapter_separator = '-@'
+
+# the file name of a page in the loose cache layout
+CACHE_LAYOUT = "{book} {chapter}.html"
+
+# parsed pages are cached with this stamp, it changes whenever the parser (or BeautifulSoup or lxml) does
+PARSER_STAMP = f"{source_stamp(__file__, Path(__file__).parent / 'helper_general.py')}|{bs4.__version__}|{etree.LIBXML_VERSION if etree else ''}"
+
+# biblegateway.org is never asked for more than this many pages at the same time
+MAX_DOWNLOADERS = 2
+
+# and never for more than this many pages per second
+MAX_RATE = 4.0
+
+# cached pages are checked with the server again after this many seconds
+CACHE_TTL = 180*24*3600
 
 def getDescription():
     return "Supports a selection of bibles from biblegateway.org. The final bible includes section titles, cross-references, and footnotes whenever provided by biblegateway.org."
 
-def getSupportedVersions():
-
-    return {"AMP":      ["Amplified Bible",                              "en"],
-            "ASV":      ["American Standard Version",                    "en"],
-            "AKJV":     ["Authorized (King James) Version",              "en"],
-            "BRG":      ["BRG Bible",                                    "en"],
-            "CSB":      ["Christian Standard Bible",                     "en"],
-            "EHV":      ["Evangelical Heritage Version",                 "en"],
-            "ESV":      ["English Standard Version",                     "en"],
-            "ESVUK":    ["English Standard Version Anglicised",          "en"],
-            "GNV":      ["1599 Geneva Bible",                            "en"],
-            "GW":       ["GOD’S WORD Translation",                       "en"],
-            "ISV":      ["International Standard Version",               "en"],
-            "JUB":      ["Jubilee Bible 2000",                           "en"],
-            "KJV":      ["King James Version",                           "en"],
-            "KJ21":     ["21st Century King James Version",              "en"],
-            "LEB":      ["Lexham English Bible",                         "en"],
-            "LSB":      ["Legacy Standard Bible",                        "en"],
-            "MEV":      ["Modern English Version",                       "en"],
-            "NASB":     ["New American Standard Bible",                  "en"],
-            "NASB1995": ["New American Standard Bible 1995",             "en"],
-            "NET":      ["New English Translation",                      "en"],
-            "NIV":      ["New International Version",                    "en"],
-            "NIVUK":    ["New International Version - UK",               "en"],
-            "NKJV":     ["New King James Version",                       "en"],
-            "NLT":      ["New Living Translation",                       "en"],
-            "NLV":      ["New Life Version",                             "en"],
-            "NMB":      ["New Matthew Bible",                            "en"],
-            "NOG":      ["Names of God Bible",                           "en"],
-            "NRSV":     ["New Revised Standard Version",                 "en"],
-            "NRSVUE":   ["New Revised Standard Version Updated Edition", "en"],
-            "RSV":      ["Revised Standard Version",                     "en"],
-            "WEB":      ["World English Bible",                          "en"],
-            "YLT":      ["Young's Literal Translation",                  "en"],
-            "RVA":      ["Reina-Valera Antigua",                         "es"],
-            "SCH2000":  ["Schlachter 2000",                              "de"],
-            "HOF":      ["Hoffnung für Alle",                            "de"],
-            "SG21":     ["Segond 21",                                    "fr"]}
+# all versions, or only the ones of the given language
+def getSupportedVersions(language=None):
+
+    versions = {"AMP":      ["Amplified Bible",                              "en"],
+                "ASV":      ["American Standard Version",                    "en"],
+                "AKJV":     ["Authorized (King James) Version",              "en"],
+                "BRG":      ["BRG Bible",                                    "en"],
+                "CSB":      ["Christian Standard Bible",                     "en"],
+                "EHV":      ["Evangelical Heritage Version",                 "en"],
+                "ESV":      ["English Standard Version",                     "en"],
+                "ESVUK":    ["English Standard Version Anglicised",          "en"],
+                "GNV":      ["1599 Geneva Bible",                            "en"],
+                "GW":       ["GOD’S WORD Translation",                       "en"],
+                "ISV":      ["International Standard Version",               "en"],
+                "JUB":      ["Jubilee Bible 2000",                           "en"],
+                "KJV":      ["King James Version",                           "en"],
+                "KJ21":     ["21st Century King James Version",              "en"],
+                "LEB":      ["Lexham English Bible",                         "en"],
+                "LSB":      ["Legacy Standard Bible",                        "en"],
+                "MEV":      ["Modern English Version",                       "en"],
+                "NASB":     ["New American Standard Bible",                  "en"],
+                "NASB1995": ["New American Standard Bible 1995",             "en"],
+                "NET":      ["New English Translation",                      "en"],
+                "NIV":      ["New International Version",                    "en"],
+                "NIVUK":    ["New International Version - UK",               "en"],
+                "NKJV":     ["New King James Version",                       "en"],
+                "NLT":      ["New Living Translation",                       "en"],
+                "NLV":      ["New Life Version",                             "en"],
+                "NMB":      ["New Matthew Bible",                            "en"],
+                "NOG":      ["Names of God Bible",                           "en"],
+                "NRSV":     ["New Revised Standard Version",                 "en"],
+                "NRSVUE":   ["New Revised Standard Version Updated Edition", "en"],
+                "RSV":      ["Revised Standard Version",                     "en"],
+                "WEB":      ["World English Bible",                          "en"],
+                "YLT":      ["Young's Literal Translation",                  "en"],
+                "RVA":      ["Reina-Valera Antigua",                         "es"],
+                "SCH2000":  ["Schlachter 2000",                              "de"],
+                "HOF":      ["Hoffnung für Alle",                            "de"],
+                "SG21":     ["Segond 21",                                    "fr"]}
+
+    return {v: versions[v] for v in versions if language is None or versions[v][1] == language}
 
 def getData(version, verbose):
+    return list(iterData(version, verbose))
 
-    return_data = []
+# Yields the chapters one by one as soon as they are available, while the following ones are still being downloaded
+def iterData(version, verbose):
 
-    printProgressBar(0, 1189+1, prefix='  Progress:', length = 40)
-    progressCounter = 0
+    if version not in getSupportedVersions():
+        print(f"ERROR: version not supported: {version}")
+        yield from [{"book" : book, "chapter" : chapter, "content" : []} for book in bible_books_chapters for chapter in range(1, bible_books_chapters[book]+1)]
+        return
 
+    # Usually every chapter is requested on its own. In whole-book mode all chapters of a book (or at most
+    # 'chapters_per_request' of them) are requested at once, which needs far fewer requests.
+    requests = []
     for book in bible_books_chapters:
+        step = (settings["chapters_per_request"] or bible_books_chapters[book]) if settings["whole_book"] else 1
+        for first in range(1, bible_books_chapters[book]+1, step):
+            requests.append((book, list(range(first, min(first+step, bible_books_chapters[book]+1)))))
+
+    # only the books this version has are requested
+    plan = planBooks(version, requests, verbose)
+    requests = [(book, chapters) for book, chapters in requests if book in plan]
+    total = sum(plan.values())
+
+    printProgressBar(0, total+1, prefix='  Progress:', length = 40)
+    progressCounter = 0
 
-        if verbose:
-            print(f"# BOOK: {book}")
+    store = open_cache("biblegateway", version, CACHE_LAYOUT)
+    parsed = open_parsed_cache("biblegateway")
+    digests = store.digests()
+    validators = store.validators()
+
+    # Pages that were parsed before are taken straight from the cache, unless they need to be checked
+    # with the server again. All other pages are downloaded (unless they are cached) and parsed.
+    known = {}
+    for i, (book, chapters) in enumerate(requests):
+        key = tuple(referenceOf(book, chapters).rsplit(" ", 1))
+        digest = digests.get(key)
+        if digest and not needs_refresh(validators.get(key), CACHE_TTL):
+            contents = parsed.get(digest, parserStamp(version, book, chapters))
+            if contents is not None:
+                known[i] = contents
+    missing = [i for i in range(len(requests)) if i not in known]
+    page_digests = {}
+
+    # The pages are downloaded by a small pool of threads (to be polite to biblegateway.org) and parsed
+    # by a pool of processes, so that waiting for the network and parsing the HTML can overlap.
+    # The parsing processes are created first, before any downloading thread exists (in a batch they
+    # were created before any build started).
+    if not missing:
+        parsers = None
+    elif settings["process_pool"]:
+        parsers = settings["process_pool"]
+    else:
+        parsers = create_process_pool(settings["processes"])
+    downloaders = ThreadPoolExecutor(max_workers=min(settings["workers"], MAX_DOWNLOADERS))
+    # the chapters missing from a page with several chapters are requested by threads of their own, so they don't
+    # wait for all the pages that are still to be downloaded (the rate limiter of the host paces them all the same)
+    retries = ThreadPoolExecutor(max_workers=min(settings["workers"], MAX_DOWNLOADERS))
+
+    def submitParse(htmltxt, j):
+        book, chapters = requests[missing[j]]
+        digest = page_digests[missing[j]] = digest_of(htmltxt.encode())
+        # a page that was checked with the server and did not change was parsed before
+        contents = parsed.get(digest, parserStamp(version, book, chapters))
+        if contents is not None:
+            done = Future()
+            done.set_result(contents)
+            return done
+        return (parsers or downloaders).submit(parseBookData, htmltxt, book, chapters, version, settings["html_parser"])
+
+    # a single chapter, like any other page: taken from the caches if it is there, otherwise downloaded and parsed
+    def retrieveChapter(book, chapter):
+        htmltxt = fetchData(referenceOf(book, [chapter]), version, verbose)
+        digest = digest_of(htmltxt.encode())
+        contents = parsed.get(digest, parserStamp(version, book, [chapter]))
+        if contents is None:
+            if parsers:
+                contents = parsers.submit(parseBookData, htmltxt, book, [chapter], version, settings["html_parser"]).result()
+            else:
+                contents = parseBookData(htmltxt, book, [chapter], version, settings["html_parser"])
+            parsed.put(digest, parserStamp(version, book, [chapter]), contents)
+        return contents[0]
 
-        for chapter in range(1, bible_books_chapters[book]+1):
+    try:
 
-            progressCounter += 1
+        downloads = [downloaders.submit(fetchData, referenceOf(*requests[i]), version, verbose) for i in missing]
+        results = chain_in_order(downloads, submitParse)
 
-            if verbose:
-                print(f"  chapter: {chapter}")
+        for i, (book, chapters) in enumerate(requests):
+
+            if i in known:
+                contents = known.pop(i)
             else:
-                printProgressBar(progressCounter, 1189+1, prefix='  Progress:', suffix=f' ({book} {chapter})           ', length = 40)
+                contents = next(results)
+                parsed.put(page_digests.pop(i), parserStamp(version, book, chapters), contents)
+
+            # Chapters that are missing from a page with several chapters are requested on their own, all at once.
+            # The page might have been cut short, so the last chapter that was found is requested again as well.
+            if None in contents:
+                found = [c for c, content in zip(chapters, contents) if content is not None]
+                contents = [retries.submit(retrieveChapter, book, c) if content is None or (found and c == found[-1]) else content
+                            for c, content in zip(chapters, contents)]
 
-            return_data.append({"book" : book,
-                                "chapter" : chapter,
-                                "content" : retrieveData(f"{book} {chapter}", version, verbose)})
+            for chapter, content in zip(chapters, contents):
 
-    printProgressBar(1189+1, 1189+1, prefix='  Progress:', suffix=f'                           ', length = 40)
+                progressCounter += 1
 
-    return return_data
+                if verbose:
+                    if chapter == 1:
+                        print(f"# BOOK: {book}")
+                    print(f"  chapter: {chapter}")
+                else:
+                    printProgressBar(progressCounter, total+1, prefix='  Progress:', suffix=f' ({book} {chapter})           ', length = 40)
+
+                if isinstance(content, Future):
+                    if verbose:
+                        print("    -> not found in combined page, requested chapter on its own.")
+                    content = content.result()
+
+                yield {"book" : book,
+                       "chapter" : chapter,
+                       "content" : content}
+
+    finally:
+        # don't keep working if something went wrong
+        downloaders.shutdown(cancel_futures=True)
+        retries.shutdown(cancel_futures=True)
+        if parsers and parsers is not settings["process_pool"]:
+            parsers.shutdown(cancel_futures=True)
+
+    printProgressBar(total+1, total+1, prefix='  Progress:', suffix=f'                           ', length = 40)
+
+###################################################################################################
+
+# The books of a version with their number of chapters, in canonical order. Biblegateway has no list of
+# the books of a version, so the first page of each book is requested: a book is missing if that page has
+# no results. Those pages are needed anyway, they are cached and used again when the book is downloaded.
+def planBooks(version, requests, verbose):
+
+    plan = load_plan("biblegateway", version)
+    if plan and not needs_refresh(plan, CACHE_TTL):
+        return plan['books']
+
+    store = open_cache("biblegateway", version, CACHE_LAYOUT)
+    first = {}
+    for book, chapters in requests:
+        first.setdefault(book, referenceOf(book, chapters))
+
+    # a cached page is good enough to know whether the book exists
+    def probe(reference):
+        htmltxt = store.get(*reference.rsplit(" ", 1))
+        return htmltxt.decode() if htmltxt is not None else fetchData(reference, version, verbose)
+
+    with ThreadPoolExecutor(max_workers=min(settings["workers"], MAX_DOWNLOADERS)) as probes:
+        pages = dict(zip(first, probes.map(probe, first.values())))
+
+    books = {book: bible_books_chapters[book] for book in first if pages[book] and "No valid results were found for your search." not in pages[book]}
+
+    return save_plan("biblegateway", version, books)['books']
 
 ###################################################################################################
 
+# The stamp a parsed page is cached with. Both parsers give the same results, but a page parsed by one
+# of them is not taken for the other one (e.g. when BeautifulSoup is chosen to check the results of lxml).
+def parserStamp(version, book, chapters):
+    return f"{PARSER_STAMP}|{settings['html_parser']}|{version}|{referenceOf(book, chapters)}"
+
+# The search term for one or several chapters of a book, e.g. "Genesis 1" or "Genesis 1-50"
+def referenceOf(book, chapters):
+    if len(chapters) == 1:
+        return f"{book} {chapters[0]}"
+    return f"{book} {chapters[0]}-{chapters[-1]}"
+
 # This function is adapted from the meaningless package, version 1.3.0:
 # https://github.com/daniel-tran/meaningless
 def retrieveData(reference, version, verbose):
@@ -90,29 +271,51 @@ def retrieveData(reference, version, verbose):
         print(f"ERROR: version not supported: {version}")
         return []
 
+    return parseData(fetchData(reference, version, verbose), reference, version)
 
-    cache_dir = Path(f"./cache/biblegateway/{version}")
-    cache_dir.mkdir(parents=True, exist_ok=True)
-    cache_file = cache_dir / f"{reference}.html"
-
-    htmltxt = ""
+def fetchData(reference, version, verbose):
+    """
+    Returns the HTML of a specific passage, either from the cache or from the Bible Gateway site
+    (which is asked whether a cached page changed once it expired). A page that doesn't exist is returned
+    as an empty string, the parse functions take it as a page without results.
+    """
 
-    if cache_file.exists():
-        with open(cache_file, "r") as f:
-            htmltxt = f.read()
-        soup = BeautifulSoup(htmltxt, 'html.parser')
+    store = open_cache("biblegateway", version, CACHE_LAYOUT)
+    book, chapter = reference.rsplit(" ", 1)
+
+    htmltxt = store.get(book, chapter)
+    if htmltxt is not None and not needs_refresh(store.get_validators(book, chapter), CACHE_TTL):
+        return htmltxt.decode()
+
+    # a page that did not exist the last time isn't requested again until that expires
+    missing = store.get_missing(book, chapter)
+    if htmltxt is None and missing and not needs_refresh(missing, CACHE_TTL):
+        return ""
+
+    # Use the printer-friendly view since there are fewer page elements to load and process
+    source_site_params = urlencode({'version': version, 'search': reference, 'interface': 'print'})
+    source_site = f'{SOURCE_URL}?{source_site_params}'
+    # the requests are paced by the rate limiter of the host, which adapts to how the server is doing
+    get_rate_limiter(source_site).limit(MAX_RATE)
+    if verbose:
+        print(f"Requesting onlne resource from: {source_site}")
+    htmltxt = download_page(store, book, chapter, source_site)
+    return htmltxt.decode() if htmltxt is not None else ""
+
+def parseData(htmltxt, reference, version, html_parser=None):
+    """
+    Extracts the passage from the HTML of the Bible Gateway site. This is CPU-bound and can be run in a separate process.
+    """
 
-    else:
+    # a page that doesn't exist (see fetchData) has no results
+    if not htmltxt:
+        return []
 
-        wait_shortly()
+    root = parseHtml(htmltxt, html_parser)
+    if root is not None:
+        return parseDataLxml(root, reference, version)
 
-        # Use the printer-friendly view since there are fewer page elements to load and process
-        source_site_params = urlencode({'version': version, 'search': reference, 'interface': 'print'})
-        source_site = f'https://www.biblegateway.com/passage/?{source_site_params}'
-        htmltxt = get_page(source_site).decode()
-        with open(cache_file, "w") as f:
-            f.write(htmltxt)
-        soup = BeautifulSoup(htmltxt, 'html.parser')
+    soup = BeautifulSoup(htmltxt, 'html.parser')
 
     # Don't collect contents from an invalid verse, since they do not exist.
     # A fail-fast approach can be taken by checking for certain indicators of invalidity.
@@ -121,21 +324,109 @@ def retrieveData(reference, version, verbose):
             print("ERROR: did not find passage content")
         return []
 
-    # To get a list, the passage separator is given an actual practical use as an indicator of where to split
-    # the string to create list elements.
-    passage_separator = '-_-'
+    return splitPassages(extractText(soup, version, lambda tag: reference))
+
+def parseBookData(htmltxt, book, chapters, version, html_parser=None):
+    """
+    Extracts several chapters of one book that were requested together from the HTML of the Bible Gateway site.
+    Returns the content for each of the chapters, or None for chapters that were not found in the page.
+    """
+
+    if len(chapters) == 1:
+        return [parseData(htmltxt, referenceOf(book, chapters), version, html_parser)]
+
+    # a page that doesn't exist (see fetchData) has no results for any of its chapters
+    if not htmltxt:
+        return [[] for c in chapters]
+
+    root = parseHtml(htmltxt, html_parser)
+    if root is not None:
+        return parseBookDataLxml(root, book, chapters, version)
+
+    soup = BeautifulSoup(htmltxt, 'html.parser')
+
+    if not soup.find('div', {'class': 'passage-content'}):
+        # the book is not part of this version: there is nothing to retrieve for any of its chapters
+        if "No valid results were found for your search." in htmltxt:
+            return [[] for c in chapters]
+        print("ERROR: did not find passage content")
+        return [None for c in chapters]
+
+    # Every verse (and every heading) is wrapped in a span with a class like 'Gen-2-4'. We put a marker in front
+    # of the first block of each chapter. If a chapter starts in the middle of a block, the marker is put directly
+    # in front of its first verse instead.
+    prevblock = None
+    prevchapter = None
+    for span in soup.find_all('span', {'class': 'text'}):
+        chapter = chapterOf(span)
+        block = span
+        while block.parent is not None and not {'text-html', 'passage-content'} & set(block.parent.get('class', [])):
+            block = block.parent
+        if chapter is not None and chapter != prevchapter:
+            (span if block is prevblock else block).insert_before(f"{chapter_separator}{chapter}{chapter_separator}")
+            prevchapter = chapter
+        prevblock = block
+
+    # the notes get the same reference as if the chapter was requested on its own
+    def noteReference(tag):
+        span = tag.find_parent('span', {'class': 'text'})
+        return f"{book} {chapterOf(span) if span else chapters[0]}"
+
+    return splitChapters(extractText(soup, version, noteReference), chapters)
+
+# split the text of several chapters into the individual chapters: the marked chapter numbers are at the odd positions
+def splitChapters(all_text, chapters):
+
+    parts = re.split(f"{chapter_separator}([0-9]+){chapter_separator}", all_text)
+    found = {int(parts[i]): splitPassages(parts[i+1]) for i in range(1, len(parts), 2)}
+
+    return [found.get(c) for c in chapters]
+
+# The chapter of a verse span, which carries a class like 'Gen-2-4' (None if there is no such class)
+def chapterOf(span):
+    for cls in classesOf(span):
+        m = re.match(r'^[0-9A-Za-z]+-([0-9]+)-[0-9]+$', cls)
+        if m:
+            return int(m.group(1))
+    return None
+
+# The classes of a tag, BeautifulSoup has them as a list and lxml as a string
+def classesOf(tag):
+    classes = tag.get('class') or []
+    return classes.split() if isinstance(classes, str) else classes
+
+# The markers of a cross-reference and a footnote, for the passage reference ("book chapter:verse") they belong to
+def crossrefMarker(reference, text, target):
+    return f"|[|{" ".join(reference.split(" ")[:-1])}|{reference.split(":")[-1]}|{text}|{target}|]|"
+
+def footnoteMarker(reference, text):
+    return f"|||{reference.split(" ")[0]}|{reference.split(":")[-1]}|{text}|||"
+
+# Extract the text of the passage, with all the markers for verses, titles, footnotes, and cross-references in place.
+# noteReference returns the passage reference ("book chapter") that a footnote or cross-reference tag belongs to.
+def extractText(soup, version, noteReference):
 
     # We preserve heading of the various types. They will be put into their own list entry at the end
     [h2.replaceWith(f"\n## {h2.text}\n") for h2 in soup.find_all("h2")]
     [h3.replaceWith(f"\n### {h3.text}\n") for h3 in soup.find_all("h3")]
     [h4.replaceWith(f"\n#### {h4.text}\n") for h4 in soup.find_all("h4")]
 
+    # The list entries of the footnotes and cross-references by their id. Looking each of them up in the whole
+    # page would get very slow for pages with several chapters.
+    notes = {}
+    for li in soup.find_all("li", id=True):
+        notes.setdefault(li['id'], li)
+
     # replace all cross-references with the respective references. This can be a comma separated list of
     # multiple references. The list starts with |[| and ends with |]|
-    [sup.replaceWith(f"|[|{" ".join(reference.split(" ")[:-1])}|{reference.split(":")[-1]}|{soup.find("li", id=sup['data-cr'][1:]).a.text}|{soup.find("li", id=sup['data-cr'][1:]).find("a", {'class', "crossref-link"})['data-bibleref']}|]|") for sup in soup.find_all("sup", {'class', "crossreference"})]
+    for sup in soup.find_all("sup", {'class', "crossreference"}):
+        reference = noteReference(sup)
+        sup.replaceWith(crossrefMarker(reference, notes[sup['data-cr'][1:]].a.text, notes[sup['data-cr'][1:]].find("a", {'class', "crossref-link"})['data-bibleref']))
 
     # replace all footnotes
-    [sup.replaceWith(f"|||{reference.split(" ")[0]}|{reference.split(":")[-1]}|{soup.find("li", id=sup['data-fn'][1:]).span.text}|||") for sup in soup.find_all("sup", {'class', 'footnote'})]
+    for sup in soup.find_all("sup", {'class', 'footnote'}):
+        reference = noteReference(sup)
+        sup.replaceWith(footnoteMarker(reference, notes[sup['data-fn'][1:]].span.text))
 
     # Compile the list of tags to remove from the parsed web page, corresponding to the following elements:
     # h1
@@ -210,6 +501,12 @@ def retrieveData(reference, version, verbose):
     raw_passage_text = '\n'.join([tag.text.replace('\xa0', ' ').strip() for tag in
                                     soup.find_all('div', {'class': 'passage-content'})]) \
         .replace('[[', '').replace(']]', '')
+
+    return cleanText(raw_passage_text, version)
+
+# The clean-up of the text of the passage, which is the same for both parsers
+def cleanText(raw_passage_text, version):
+
     # To account for spaces between tags that end up blending into the passage contents, this regex replacement is
     # specifically used to remove that additional spacing, since it is part of the actual page layout.
     all_text = re.sub('([^ ]) {2,3}([^ ])', r'\1 \2', raw_passage_text)
@@ -241,6 +538,279 @@ def retrieveData(reference, version, verbose):
     # This logic would need to be revisited if there are cases of pilcrows without a trailing space.
     all_text = all_text.replace('⌞', '').replace('⌟', '').replace('¶ ', '')
 
+    return all_text
+
+###################################################################################################
+# The fast path: the same extraction with lxml
+#
+# libxml2 parses the page a lot faster than html.parser, and the tree is searched in C. The steps are
+# exactly those of the BeautifulSoup version above, in the same order, so the text comes out the same.
+# That only holds where libxml2 builds the same tree as html.parser, which it does for well-formed
+# pages. But libxml2 closes some tags on its own (e.g. a <p> before a <div>, or an unclosed <li> before
+# the next one) where html.parser nests them, it resolves some character references differently, and
+# it turns \r\n into \n. Pages like that are parsed by BeautifulSoup (see parseHtml). compareParsers()
+# checks that both give the same results for all cached pages.
+
+# tags that libxml2 closes implicitly, which html.parser never does
+implicitly_closed_pattern = re.compile(r"<(/?)(p|li|dt|dd|td|th|tr|thead|tbody|tfoot|option|optgroup)[\s/>]", re.IGNORECASE)
+
+# tags that BeautifulSoup knows to be empty and libxml2 doesn't (unless they are written as <tag />)
+unclosed_empty_pattern = re.compile(r"<(?:embed|keygen|menuitem|source|track|wbr|bgsound|command|image|nextid|spacer)\b[^<>]*(?<!/)>", re.IGNORECASE)
+
+# The tags of the document itself. html.parser starts a new element for every <html>, <head> or <body>,
+# and it closes all tags at </body> or </html>, libxml2 ignores them where they don't belong.
+document_tag_pattern = re.compile(r"<(html|head|body)[\s>]", re.IGNORECASE)
+document_end_pattern = re.compile(r"</(?:html|body)\b", re.IGNORECASE)
+document_trailer_pattern = re.compile(r"(?:\s*</(?:html|body)\s*>|\s*<!--.*?-->)*\s*", re.IGNORECASE | re.DOTALL)
+
+# The text of the page without tags, comments, scripts and styles (they are replaced by a "<", so that
+# a reference doesn't run into the text after a tag), and the character references in it
+markup_pattern = re.compile(r"<script\b.*?</script\s*>|<style\b.*?</style\s*>|<!--.*?-->|<[^>]*>", re.DOTALL | re.IGNORECASE)
+reference_pattern = re.compile(r"&(#?[a-zA-Z0-9][-.a-zA-Z0-9]*)(;?)")
+
+# Whether html.parser (with BeautifulSoup) and libxml2 resolve a character reference the same way. They
+# don't for references without a semicolon (e.g. &copy2024), unknown ones (e.g. &foo;), and a few others.
+def sameReference(name, semicolon):
+
+    if not semicolon:
+        return False
+    if name.startswith("#"):
+        hexadecimal = name[1] in "xX"
+        try:
+            return int(name[2:] if hexadecimal else name[1:], 16 if hexadecimal else 10) not in (9, 12, 13)
+        except ValueError:
+            return False
+    return name != "Tab" and f"{name};" in html_entities
+
+# Tags whose content html.parser and libxml2 treat differently (as text or as tags), or whose text
+# BeautifulSoup leaves out of the text of a tag. They must not be part of the passage.
+differing_tags = ("template", "rt", "rp", "title", "textarea", "noscript", "iframe", "noembed", "noframes", "xmp", "plaintext")
+
+# The parsed page, or None if it should be parsed by BeautifulSoup: if that was asked for, lxml is not
+# installed, or libxml2 would build a different tree. Pages without a passage (i.e. no results) are
+# left to BeautifulSoup as well, they are short.
+def parseHtml(htmltxt, html_parser=None):
+
+    if (html_parser or settings["html_parser"]) != "lxml" or etree is None:
+        return None
+
+    # only the passage and what follows it matter for the text
+    start = htmltxt.find("passage-content")
+    if start < 0:
+        return None
+    start = max(0, htmltxt.rfind("<", 0, start))
+
+    # libxml2 turns \r\n into \n, html.parser keeps it (and form feeds are whitespace only for BeautifulSoup)
+    if "\r" in htmltxt[start:] or "\f" in htmltxt[start:]:
+        return None
+
+    # character references in the text that are resolved differently
+    if any(not sameReference(*reference) for reference in set(reference_pattern.findall(markup_pattern.sub("<", htmltxt[start:])))):
+        return None
+
+    if unclosed_empty_pattern.search(htmltxt):
+        return None
+
+    tags = [tag.lower() for tag in document_tag_pattern.findall(htmltxt)]
+    end = document_end_pattern.search(htmltxt)
+    if len(set(tags)) < len(tags) or (end and not document_trailer_pattern.fullmatch(htmltxt, end.start())):
+        return None
+
+    # every tag that is closed implicitly somewhere is a tag that is not closed at all
+    opened = {}
+    for closing, tag in implicitly_closed_pattern.findall(htmltxt):
+        opened[tag.lower()] = opened.get(tag.lower(), 0) + (-1 if closing else 1)
+    if any(opened.values()):
+        return None
+
+    parser = etree.HTMLParser(encoding="utf-8")
+    root = etree.fromstring(htmltxt.encode(), parser)
+    # a tag that is closed in the wrong place (html.parser and libxml2 recover from that differently)
+    if root is None or any(e.type_name == "ERR_TAG_NAME_MISMATCH" for e in parser.error_log):
+        return None
+
+    contents = passageContents(root)
+    if not contents:
+        return None
+    for content in contents:
+        if next(content.iter(*differing_tags), None) is not None:
+            return None
+        # libxml2 makes comments of CDATA sections, their text is part of the text for BeautifulSoup
+        if any(comment.text.startswith("[CDATA[") for comment in content.iter(etree.Comment)):
+            return None
+
+    # BeautifulSoup leaves the content of scripts and styles out of the text of a tag
+    for tag in root.iter("script", "style"):
+        tag.text = None
+
+    # and it replaces every text that is only whitespace by a single space (or newline), except in <pre>
+    for text in root.xpath("//text()[not(normalize-space())][not(ancestor::pre)]"):
+        space = "\n" if "\n" in text else " "
+        if text != space:
+            if text.is_tail:
+                text.getparent().tail = space
+            else:
+                text.getparent().text = space
+
+    return root
+
+# the tags of the given name with any of the given classes, in the order of the page
+def findTags(root, name, classes=None):
+    if classes is None:
+        return list(root.iter(name))
+    return [tag for tag in root.iter(name) if not classes.isdisjoint((tag.get('class') or "").split())]
+
+def passageContents(root):
+    return findTags(root, 'div', {'passage-content'})
+
+# The text of a tag, like .text of BeautifulSoup (comments are left out, and the content of scripts was removed)
+def textOf(tag):
+    return "".join(tag.itertext())
+
+# Insert a text in front of a tag, or put it in place of the tag. lxml keeps the text that follows
+# a tag in its tail, which has to stay in place.
+def insertText(tag, text):
+    previous = tag.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or "") + text
+    else:
+        parent = tag.getparent()
+        parent.text = (parent.text or "") + text
+
+def replaceTag(tag, text=""):
+    insertText(tag, text + (tag.tail or ""))
+    tag.getparent().remove(tag)
+
+def parseDataLxml(root, reference, version):
+    return splitPassages(extractTextLxml(root, version, lambda tag: reference))
+
+def parseBookDataLxml(root, book, chapters, version):
+
+    # the chapters are marked as in parseBookData
+    prevblock = None
+    prevchapter = None
+    for span in findTags(root, 'span', {'text'}):
+        chapter = chapterOf(span)
+        block = span
+        while block.getparent() is not None and not {'text-html', 'passage-content'} & set(classesOf(block.getparent())):
+            block = block.getparent()
+        if chapter is not None and chapter != prevchapter:
+            insertText(span if block is prevblock else block, f"{chapter_separator}{chapter}{chapter_separator}")
+            prevchapter = chapter
+        prevblock = block
+
+    def noteReference(tag):
+        span = next((p for p in tag.iterancestors('span') if 'text' in classesOf(p)), None)
+        return f"{book} {chapterOf(span) if span is not None else chapters[0]}"
+
+    return splitChapters(extractTextLxml(root, version, noteReference), chapters)
+
+# The same as extractText, see there for what each step is for
+def extractTextLxml(root, version, noteReference):
+
+    for level in (2, 3, 4):
+        for h in findTags(root, f"h{level}"):
+            replaceTag(h, f"\n{'#'*level} {textOf(h)}\n")
+
+    notes = {}
+    for li in root.iter("li"):
+        if li.get('id') is not None:
+            notes.setdefault(li.get('id'), li)
+
+    # the first tag of the given name (and with any of the given classes) in a note, like .find() of BeautifulSoup
+    def find(note, name, classes=None):
+        return next((tag for tag in note.iter(name) if classes is None or not classes.isdisjoint(classesOf(tag))), None)
+
+    for sup in findTags(root, "sup", {'class', "crossreference"}):
+        reference = noteReference(sup)
+        note = notes[sup.attrib['data-cr'][1:]]
+        replaceTag(sup, crossrefMarker(reference, textOf(find(note, 'a')), find(note, 'a', {'class', "crossref-link"}).attrib['data-bibleref']))
+
+    for sup in findTags(root, "sup", {'class', "footnote"}):
+        reference = noteReference(sup)
+        note = notes[sup.attrib['data-fn'][1:]]
+        replaceTag(sup, footnoteMarker(reference, textOf(find(note, 'span'))))
+
+    removable_tags = findTags(root, 'h1') \
+        + findTags(root, 'a', {'full-chap-link', 'bibleref'}) \
+        + findTags(root, 'sup', {'crossreference', 'footnote'}) \
+        + findTags(root, 'div', {'footnotes', 'dropdowns', 'crossrefs', 'passage-other-trans'}) \
+        + findTags(root, 'p', {'translation-note'}) \
+        + findTags(root, 'crossref')
+    if version == 'GNV':
+        removable_tags += findTags(root, 'p', {'first-line-none'})
+    [replaceTag(tag) for tag in removable_tags]
+
+    interludes = findTags(root, 'span', {'selah'}) + findTags(root, 'i', {'selah'}) + findTags(root, 'selah')
+    [replaceTag(interlude, f' {textOf(interlude)}') for interlude in interludes]
+    [replaceTag(br, '\n') for br in findTags(root, 'br')]
+    if version == 'NIVUK':
+        [replaceTag(versenum, passage_separator) for versenum in findTags(root, 'versenum')]
+    [replaceTag(chapter_num, '\n') for chapter_num in findTags(root, 'span', {'chapternum'})]
+    [replaceTag(sup, passage_separator) for sup in findTags(root, 'sup', {'versenum'})]
+    [replaceTag(td, f'{textOf(td)} ') for td in findTags(root, 'td')[::2]]
+    # this must be the last step, as above
+    [replaceTag(p, f'\n{textOf(p)}') for p in findTags(root, 'p')]
+
+    raw_passage_text = '\n'.join([textOf(tag).replace('\xa0', ' ').strip() for tag in passageContents(root)]) \
+        .replace('[[', '').replace(']]', '')
+
+    return cleanText(raw_passage_text, version)
+
+# Parse all cached pages of a version with both parsers and report the pages with different results.
+# Returns whether the results were the same for all pages.
+def compareParsers(version, verbose):
+
+    if etree is None:
+        print(" lxml is not installed, all pages are parsed by BeautifulSoup.")
+        return True
+
+    store = open_cache("biblegateway", version, CACHE_LAYOUT)
+    order = {book: i for i, book in enumerate(bible_books_chapters)}
+    pages = sorted(store.keys(), key=lambda key: (order.get(key[0], len(order)), int(key[1].split("-")[0])))
+
+    seconds = {"bs4": 0.0, "lxml": 0.0}
+    different = 0
+    fallbacks = 0
+
+    for book, chapter in pages:
+
+        htmltxt = store.get(book, chapter).decode()
+        first, _, last = chapter.partition("-")
+        chapters = list(range(int(first), int(last or first)+1))
+
+        results = {}
+        for html_parser in seconds:
+            start = time.perf_counter()
+            try:
+                results[html_parser] = parseBookData(htmltxt, book, chapters, version, html_parser)
+            except Exception as e:
+                results[html_parser] = f"{type(e).__name__}: {e}"
+            seconds[html_parser] += time.perf_counter() - start
+
+        if parseHtml(htmltxt, "lxml") is None:
+            fallbacks += 1
+
+        if results["bs4"] != results["lxml"]:
+            different += 1
+            print(f"  {book} {chapter}: the results differ")
+            if verbose:
+                a, b = str(results["bs4"]), str(results["lxml"])
+                i = next((i for i in range(min(len(a), len(b))) if a[i] != b[i]), min(len(a), len(b)))
+                print(f"    BeautifulSoup: ...{a[max(0, i-60):i+60]}...")
+                print(f"             lxml: ...{b[max(0, i-60):i+60]}...")
+        elif verbose:
+            print(f"  {book} {chapter}: same results")
+
+    print("")
+    print(f" {len(pages)} cached pages compared, {different} with different results.")
+    print(f" {fallbacks} of them had to be parsed by BeautifulSoup with lxml as well.")
+    print(f" BeautifulSoup took {seconds['bs4']:.1f}s, lxml {seconds['lxml']:.1f}s.")
+
+    return different == 0
+
+# Split the extracted text of a passage into the list of verses, titles and section breaks SID expects
+def splitPassages(all_text):
 
     # At this point, the expectation is that the return value is a list of passages.
     # Since the passage separator is placed before the passage number, it can cause an empty first item upon
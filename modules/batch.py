@@ -0,0 +1,145 @@
+import fnmatch
+import time
+import traceback
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from modules.worker import *
+from modules.helper_general import settings, create_process_pool, rate_limiter_metrics, print_rate_metrics
+
+##################################################################
+##################################################################
+# Batch builds: many (backend, version) pairs in one invocation.
+#
+# A job is written as "backend:version", e.g. "aolab:BSB". The version
+# can be a glob pattern like "aolab:eng*", which selects all matching
+# versions of the backend. A manifest file has one job per line, empty
+# lines and lines starting with # are ignored.
+
+def read_manifest(path):
+
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f]
+
+# returns the list of (backend, version) pairs for the given job specifications
+def parse_jobs(specs):
+
+    jobs = []
+    versions = {}
+
+    for spec in specs:
+
+        spec = spec.strip()
+        if spec == "" or spec.startswith("#"):
+            continue
+
+        if ":" in spec:
+            backend, pattern = spec.split(":", 1)
+        elif len(spec.split()) == 2:
+            backend, pattern = spec.split()
+        else:
+            raise ValueError(f"Invalid job '{spec}', expected 'backend:version'")
+        backend, pattern = backend.strip(), pattern.strip()
+
+        if backend not in backends:
+            raise ValueError(f"The requested backend ({backend}) is not available. Possible backends are: {", ".join(backends)}")
+
+        # the supported versions are only requested once per backend
+        if backend not in versions:
+            versions[backend] = load_backend(backend).getSupportedVersions()
+
+        matches = [v for v in versions[backend] if fnmatch.fnmatchcase(v, pattern)]
+        if not matches:
+            raise ValueError(f"No version of the backend '{backend}' matches '{pattern}'")
+
+        for v in matches:
+            if (backend, v) not in jobs:
+                jobs.append((backend, v))
+
+    return jobs
+
+##################################################################
+##################################################################
+# Run all jobs, 'parallel' of them at the same time.
+#
+# All jobs share the cache stores, the connections and the per-host
+# rate limits and concurrency limits, so several versions from the
+# same server don't overwhelm it. Each job builds in its own directory,
+# and the compiles of several jobs run at the same time.
+# The status of every job is returned (and printed at the end).
+
+def run_batch(jobs, parallel, preserve_xml, verbose):
+
+    # the progress bars of several builds would overwrite each other
+    settings["progress"] = False
+
+    # the parsing processes are shared by all jobs, and are forked before any job thread exists
+    if settings["processes"] > 1:
+        settings["process_pool"] = create_process_pool(settings["processes"])
+
+    status = [{"backend": backend, "version": version, "status": "queued", "seconds": 0.0, "error": ""} for backend, version in jobs]
+    print_lock = Lock()
+
+    def report(i, message):
+        with print_lock:
+            print(f"  [{i+1:>{len(str(len(jobs)))}}/{len(jobs)}] {jobs[i][1]} ({jobs[i][0]}): {message}")
+
+    def run(i):
+
+        backend, version = jobs[i]
+        job = status[i]
+        job["status"] = "running"
+        start = time.monotonic()
+        report(i, "started")
+
+        try:
+            mod = load_backend(backend)
+            all_versions = mod.getSupportedVersions()
+            name = f"{version}_{backend.replace(".","")}"
+            generate_module(name=name,
+                            content=iter_backend_data(mod, version, verbose),
+                            longname=all_versions[version][0],
+                            language=all_versions[version][1],
+                            description=f"{version} ({backend})",
+                            author="SID",
+                            preserve_xml=preserve_xml,
+                            verbose=verbose)
+            job["status"] = "done"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = f"{type(e).__name__}: {e}"
+            if verbose:
+                with print_lock:
+                    traceback.print_exc()
+
+        job["seconds"] = time.monotonic() - start
+        report(i, f"{job['status']} after {job['seconds']:.1f}s" + (f" - {job['error']}" if job["error"] else ""))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            list(pool.map(run, range(len(jobs))))
+    finally:
+        if settings["process_pool"]:
+            settings["process_pool"].shutdown(cancel_futures=True)
+            settings["process_pool"] = None
+        settings["progress"] = True
+
+    print_summary(status)
+
+    return status
+
+def print_summary(status):
+
+    print("")
+    print(" Summary:")
+    print("")
+    for job in status:
+        print(f"  {job['status']:>7} | {job['seconds']:>8.1f}s | {job['version']} ({job['backend']})" + (f" - {job['error']}" if job["error"] else ""))
+    print("")
+    failed = len([job for job in status if job["status"] != "done"])
+    print(f" {len(status)-failed} of {len(status)} modules built" + (f", {failed} failed." if failed else "."))
+
+    if rate_limiter_metrics():
+        print("")
+        print(" Servers:")
+        print("")
+        print_rate_metrics()
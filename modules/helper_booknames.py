@@ -1,3 +1,7 @@
+import re
+import functools
+import unicodedata
+
 ##################################################################
 ##################################################################
 # MAP common book names to their respective OSIS names
@@ -222,46 +226,246 @@ book_name2usfm_map = {
     "revelation" : "REV"
 }
 
-def convert_bookname_to_osis(in_book):
+##################################################################
+##################################################################
+# Other names of the books
+#
+# Common abbreviations, and the names of the books in the languages
+# of the versions we build. Names that differ only in case, spaces,
+# dots or accents don't need to be listed (see book_key).
 
-    key = in_book.strip().lower()
+book_abbreviations = {
+    "Genesis": ["Ge", "Gn"],
+    "Exodus": ["Ex", "Exo"],
+    "Leviticus": ["Le", "Lv"],
+    "Numbers": ["Nu", "Nm", "Nb"],
+    "Deuteronomy": ["De", "Dt"],
+    "Joshua": ["Jsh"],
+    "Judges": ["Jg", "Jdgs"],
+    "Ruth": ["Rth", "Ru"],
+    "1 Samuel": ["1 Sm", "1 S"],
+    "2 Samuel": ["2 Sm", "2 S"],
+    "1 Kings": ["1 Ki", "1 Kin"],
+    "2 Kings": ["2 Ki", "2 Kin"],
+    "1 Chronicles": ["1 Ch", "1 Chron"],
+    "2 Chronicles": ["2 Ch", "2 Chron"],
+    "Ezra": ["Ezr"],
+    "Nehemiah": ["Ne"],
+    "Esther": ["Es"],
+    "Job": ["Jb"],
+    "Psalms": ["Ps", "Psa", "Psm", "Pss"],
+    "Proverbs": ["Pro", "Prv", "Pr"],
+    "Ecclesiastes": ["Eccles", "Ecc", "Ec", "Qoh", "Qoheleth"],
+    "Song of Songs": ["SOS", "So", "Cant", "Canticles", "Canticle of Canticles"],
+    "Isaiah": ["Is"],
+    "Jeremiah": ["Je", "Jr"],
+    "Lamentations": ["La"],
+    "Ezekiel": ["Eze", "Ezk"],
+    "Daniel": ["Da", "Dn"],
+    "Hosea": ["Ho"],
+    "Joel": ["Jl"],
+    "Amos": ["Am"],
+    "Obadiah": ["Ob"],
+    "Jonah": ["Jnh"],
+    "Micah": ["Mi"],
+    "Nahum": ["Na"],
+    "Habakkuk": ["Hb"],
+    "Zephaniah": ["Zep", "Zp"],
+    "Haggai": ["Hg"],
+    "Zechariah": ["Zec", "Zc"],
+    "Malachi": ["Ml"],
+    "Matthew": ["Mat", "Mt"],
+    "Mark": ["Mrk", "Mar", "Mk", "Mr"],
+    "Luke": ["Luk", "Lk"],
+    "John": ["Joh", "Jn"],
+    "Acts": ["Act", "Ac"],
+    "Romans": ["Ro", "Rm"],
+    "1 Corinthians": ["1 Co"],
+    "2 Corinthians": ["2 Co"],
+    "Galatians": ["Ga"],
+    "Ephesians": ["Ephes"],
+    "Philippians": ["Pp"],
+    "Colossians": [],
+    "1 Thessalonians": ["1 Thes", "1 Th"],
+    "2 Thessalonians": ["2 Thes", "2 Th"],
+    "1 Timothy": ["1 Ti"],
+    "2 Timothy": ["2 Ti"],
+    "Titus": ["Tit"],
+    "Philemon": ["Philem", "Pm"],
+    "Hebrews": [],
+    "James": ["Jm"],
+    "1 Peter": ["1 Pe", "1 Pt"],
+    "2 Peter": ["2 Pe", "2 Pt"],
+    "1 John": ["1 Jhn", "1 Jo", "1 Joh"],
+    "2 John": ["2 Jhn", "2 Jo", "2 Joh"],
+    "3 John": ["3 Jhn", "3 Jo", "3 Joh"],
+    "Jude": ["Jd"],
+    "Revelation": ["Re", "Revelations", "Apocalypse"],
+}
 
-    allparts = key.split("-")
+# the names in other languages, in the order of bible_books_chapters
+book_names_localized = {
+    "de": ["1. Mose", "2. Mose", "3. Mose", "4. Mose", "5. Mose", "Josua", "Richter", "Rut", "1. Samuel", "2. Samuel",
+           "1. Könige", "2. Könige", "1. Chronik", "2. Chronik", "Esra", "Nehemia", "Ester", "Hiob", "Psalmen", "Sprüche",
+           "Prediger", "Hoheslied", "Jesaja", "Jeremia", "Klagelieder", "Hesekiel", "Daniel", "Hosea", "Joel", "Amos",
+           "Obadja", "Jona", "Micha", "Nahum", "Habakuk", "Zefanja", "Haggai", "Sacharja", "Maleachi",
+           "Matthäus", "Markus", "Lukas", "Johannes", "Apostelgeschichte", "Römer", "1. Korinther", "2. Korinther", "Galater",
+           "Epheser", "Philipper", "Kolosser", "1. Thessalonicher", "2. Thessalonicher", "1. Timotheus", "2. Timotheus", "Titus",
+           "Philemon", "Hebräer", "Jakobus", "1. Petrus", "2. Petrus", "1. Johannes", "2. Johannes", "3. Johannes", "Judas", "Offenbarung"],
+    "es": ["Génesis", "Éxodo", "Levítico", "Números", "Deuteronomio", "Josué", "Jueces", "Rut", "1 Samuel", "2 Samuel",
+           "1 Reyes", "2 Reyes", "1 Crónicas", "2 Crónicas", "Esdras", "Nehemías", "Ester", "Job", "Salmos", "Proverbios",
+           "Eclesiastés", "Cantares", "Isaías", "Jeremías", "Lamentaciones", "Ezequiel", "Daniel", "Oseas", "Joel", "Amós",
+           "Abdías", "Jonás", "Miqueas", "Nahúm", "Habacuc", "Sofonías", "Hageo", "Zacarías", "Malaquías",
+           "Mateo", "Marcos", "Lucas", "Juan", "Hechos", "Romanos", "1 Corintios", "2 Corintios", "Gálatas",
+           "Efesios", "Filipenses", "Colosenses", "1 Tesalonicenses", "2 Tesalonicenses", "1 Timoteo", "2 Timoteo", "Tito",
+           "Filemón", "Hebreos", "Santiago", "1 Pedro", "2 Pedro", "1 Juan", "2 Juan", "3 Juan", "Judas", "Apocalipsis"],
+    "fr": ["Genèse", "Exode", "Lévitique", "Nombres", "Deutéronome", "Josué", "Juges", "Ruth", "1 Samuel", "2 Samuel",
+           "1 Rois", "2 Rois", "1 Chroniques", "2 Chroniques", "Esdras", "Néhémie", "Esther", "Job", "Psaumes", "Proverbes",
+           "Ecclésiaste", "Cantique des Cantiques", "Ésaïe", "Jérémie", "Lamentations", "Ézéchiel", "Daniel", "Osée", "Joël", "Amos",
+           "Abdias", "Jonas", "Michée", "Nahum", "Habacuc", "Sophonie", "Aggée", "Zacharie", "Malachie",
+           "Matthieu", "Marc", "Luc", "Jean", "Actes", "Romains", "1 Corinthiens", "2 Corinthiens", "Galates",
+           "Éphésiens", "Philippiens", "Colossiens", "1 Thessaloniciens", "2 Thessaloniciens", "1 Timothée", "2 Timothée", "Tite",
+           "Philémon", "Hébreux", "Jacques", "1 Pierre", "2 Pierre", "1 Jean", "2 Jean", "3 Jean", "Jude", "Apocalypse"],
+}
+
+# other common names that are not simply a translation of the English one
+book_names_other = {
+    "Psalms": ["Psalm", "Salmo", "Psaume"],
+    "Song of Songs": ["Song of Solomon", "Cantar de los Cantares", "Cantique"],
+    "Ecclesiastes": ["Kohelet", "Qohéleth"],
+    "Job": ["Ijob"],
+    "Isaiah": ["Isaïe"],
+    "Proverbs": ["Sprichwörter"],
+    "Ezekiel": ["Ezechiel"],
+    "Zephaniah": ["Zephanja"],
+    "Acts": ["Hechos de los Apóstoles", "Actes des Apôtres"],
+    "Revelation": ["The Revelation", "Revelation of John"],
+}
 
-    ret = ""
+##################################################################
+##################################################################
+# The index of all names of the books
+#
+# It is built once, and maps the key of every name to the name of the
+# book as used in bible_books_chapters. The OSIS and USFM ids of the
+# books count as names as well. Where two names have the same key,
+# the one of the first category wins: the English names, the ids, the
+# abbreviations, the names in other languages and the other names, and
+# last the spelling variants of all of them.
 
-    for ap in allparts:
+numerals = {"1": ["I", "First"], "2": ["II", "Second"], "3": ["III", "Third"]}
 
-        if ret != "":
-            ret += "-"
+# the key of a name: lower case, without accents, dots and spaces
+def book_key(name):
+    name = unicodedata.normalize("NFKD", name.lower())
+    return "".join(c for c in name if c not in ". \t" and not unicodedata.combining(c))
 
-        parts = ap.split(" ")
-        if ":" in parts[-1] or parts[-1].isdigit():
-            book = " ".join(parts[:-1])
-            loc = parts[-1]
-        else:
-            book = " ".join(parts)
-            loc = ""
+def build_book_index():
 
-        if book not in book_name2osis_map:
-            raise ValueError(f"Unknown book name: {in_book}")
-        ret += f"{book_name2osis_map[book]} {loc}".strip()
+    osis = {book: book_name2osis_map[book.lower()] for book in bible_books_chapters}
+    usfm = {book: book_name2usfm_map[book.lower()] for book in bible_books_chapters}
 
-    return ret
+    # the names of the books by category, in the order of their precedence
+    english = {book: [book] for book in bible_books_chapters}
+    for alias, osis_id in book_name2osis_map.items():
+        english[next(book for book in bible_books_chapters if osis[book] == osis_id)].append(alias)
+    ids = {book: [osis[book], usfm[book]] for book in bible_books_chapters}
+    abbreviations = {book: book_abbreviations.get(book, []) for book in bible_books_chapters}
+    localized = {book: [] for book in bible_books_chapters}
+    for language in book_names_localized.values():
+        for book, name in zip(bible_books_chapters, language):
+            localized[book].append(name)
+    others = {book: book_names_other.get(book, []) for book in bible_books_chapters}
+    categories = [english, ids, abbreviations, localized, others]
 
+    index = {}
+    for names in categories:
+        for book in bible_books_chapters:
+            for name in names[book]:
+                index.setdefault(book_key(name), book)
 
-def convert_bookname_to_usfm(in_book):
+    # the spelling variants come last, so they never hide a name ("I S" is not "Is")
+    for names in categories:
+        for book in bible_books_chapters:
+            for name in names[book]:
+                variants = [name.replace("ä", "ae").replace("ö", "oe").replace("ü", "ue")]
+                # "1 Samuel" is also "I Samuel" and "First Samuel"
+                number = name[:1]
+                if number in numerals and name[1:2] in (" ", "."):
+                    variants += [f"{n} {name[2:].strip()}" for n in numerals[number]]
+                for v in variants:
+                    index.setdefault(book_key(v), book)
 
-    key = in_book.strip().lower()
+    return index, osis, usfm
 
-    allparts = key.split("-")
+book_index, book_osis_ids, book_usfm_ids = build_book_index()
 
-    ret = ""
+# the name of the book (as in bible_books_chapters) for any of its names, None if it is unknown
+@functools.lru_cache(maxsize=4096)
+def resolve_book(name):
+    return book_index.get(book_key(name))
 
-    for ap in allparts:
+##################################################################
+##################################################################
+# Parse references like "John 3:16", "1 Cor 13", "Ps 23:1-6",
+# "Gen 1:1-2:3" or "Gen 50-Exod 1" into a tuple of the first and the
+# last (book, chapter, verse) of the range. A single verse or chapter
+# is a range that starts and ends there. The chapter and verse are
+# None if they are not given, and a single number after a book with
+# only one chapter is a verse ("Jude 3"). Raises a ValueError if the
+# reference can't be parsed.
 
-        if ret != "":
-            ret += "-"
+location_pattern = re.compile(r"^(.*?)\s*(\d+)?(?:[:.,](\d+))?$")
+
+def parse_location(text, book=None, chapter=None, verse=None):
+
+    m = location_pattern.match(text.strip())
+    name, first, second = m.group(1), m.group(2), m.group(3)
+
+    if name:
+        book = resolve_book(name)
+        if book is None:
+            raise ValueError(f"Unknown book name: {name}")
+        if first is None:
+            return book, None, None
+        if second is not None:
+            return book, int(first), int(second)
+        if bible_books_chapters[book] == 1:
+            return book, 1, int(first)
+        return book, int(first), None
+
+    if book is None or first is None:
+        raise ValueError(f"Invalid reference: {text}")
+
+    # only numbers: continue the range in the same book
+    if second is not None:
+        return book, int(first), int(second)
+    if verse is not None:
+        return book, chapter, int(first)
+    return book, int(first), None
+
+@functools.lru_cache(maxsize=16384)
+def parse_reference(ref):
+
+    parts = ref.replace("–", "-").replace("—", "-").split("-")
+    if len(parts) > 2:
+        raise ValueError(f"Invalid reference: {ref}")
+
+    start = parse_location(parts[0])
+    end = parse_location(parts[1], *start) if len(parts) == 2 else start
+
+    return start, end
+
+##################################################################
+##################################################################
+# Convert book names (possibly with a location, like "John 3:16" or
+# "Gen 1:1-Gen 1:3") to OSIS or USFM, keeping the location as it is.
+
+def convert_bookname(in_book, ids):
+
+    ret = []
+
+    for ap in in_book.strip().lower().split("-"):
 
         parts = ap.split(" ")
         if ":" in parts[-1] or parts[-1].isdigit():
@@ -271,8 +475,25 @@ def convert_bookname_to_usfm(in_book):
             book = " ".join(parts)
             loc = ""
 
-        if book not in book_name2usfm_map:
-            raise ValueError(f"Unknown book name: {in_book} ({book})")
-        ret += f"{book_name2usfm_map[book]} {loc}".strip()
+        name = book_index.get(book_key(book))
+        if name is None:
+            raise KeyError(book)
+        ret.append(f"{ids[name]} {loc}".strip())
+
+    return "-".join(ret)
+
+@functools.lru_cache(maxsize=16384)
+def convert_bookname_to_osis(in_book):
+
+    try:
+        return convert_bookname(in_book, book_osis_ids)
+    except KeyError:
+        raise ValueError(f"Unknown book name: {in_book}") from None
+
+@functools.lru_cache(maxsize=16384)
+def convert_bookname_to_usfm(in_book):
 
-    return ret
+    try:
+        return convert_bookname(in_book, book_usfm_ids)
+    except KeyError as e:
+        raise ValueError(f"Unknown book name: {in_book} ({e.args[0]})") from None
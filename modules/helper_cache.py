@@ -0,0 +1,561 @@
+import hashlib
+import json
+import re
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+from urllib.error import HTTPError
+from threading import Lock
+from .helper_general import settings, get_response
+
+# zstd is optional: without it, the cached pages are compressed with zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+##################################################################
+##################################################################
+# Storage for the raw pages downloaded by the backends.
+#
+# There are two kinds of stores with the same interface:
+#  - PackCache:  one SQLite file per backend and version, with the pages
+#                stored compressed and only once per content (default)
+#  - LooseCache: one plain file per page (the original layout)
+#
+# Pages are identified by book and chapter. The chapter is stored as
+# a string, so it can also be a range like "1-50".
+#
+# Together with every page, its validators are stored: the ETag and
+# Last-Modified headers of the response, and when it was fetched. With
+# them, a cached page can be checked with a conditional request that
+# only returns the page again if it was changed.
+#
+# Pages that don't exist upstream (404/410) are remembered as missing,
+# so they are not requested again until the entry expires.
+
+def digest_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+def compress(data):
+    if zstandard:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 6)
+
+def decompress(codec, data):
+    if codec == "zstd":
+        if not zstandard:
+            raise RuntimeError("This cache was written with zstd compression, please install the 'zstandard' package.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    return data
+
+class PackCache:
+
+    def __init__(self, path, backend, version):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.backend = backend
+        self.version = version
+        self.lock = Lock()
+        # the connection is shared by all download threads and guarded by the lock
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, codec TEXT, data BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (backend TEXT, version TEXT, book TEXT, chapter TEXT, digest TEXT, "
+                        "PRIMARY KEY (backend, version, book, chapter))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS validators (backend TEXT, version TEXT, book TEXT, chapter TEXT, etag TEXT, last_modified TEXT, fetched_at REAL, "
+                        "PRIMARY KEY (backend, version, book, chapter))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS missing (backend TEXT, version TEXT, book TEXT, chapter TEXT, status INTEGER, fetched_at REAL, "
+                        "PRIMARY KEY (backend, version, book, chapter))")
+
+    def get(self, book, chapter):
+        with self.lock:
+            row = self.db.execute("SELECT blobs.codec, blobs.data FROM entries JOIN blobs ON entries.digest = blobs.digest "
+                                  "WHERE backend = ? AND version = ? AND book = ? AND chapter = ?",
+                                  (self.backend, self.version, book, str(chapter))).fetchone()
+        if row is None:
+            return None
+        return decompress(*row)
+
+    def put(self, book, chapter, data, validators=None):
+        digest = digest_of(data)
+        codec, blob = compress(data)
+        key = (self.backend, self.version, book, str(chapter))
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                old = self.db.execute("SELECT digest FROM entries WHERE backend = ? AND version = ? AND book = ? AND chapter = ?", key).fetchone()
+                self.db.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)", (digest, codec, blob))
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", key + (digest,))
+                if validators:
+                    self.db.execute("INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    key + (validators.get("etag"), validators.get("last_modified"), validators.get("fetched_at")))
+                self.db.execute("DELETE FROM missing WHERE backend = ? AND version = ? AND book = ? AND chapter = ?", key)
+                # remove the previous content of this page if nothing else refers to it anymore
+                if old and old[0] != digest:
+                    self.db.execute("DELETE FROM blobs WHERE digest = ? AND NOT EXISTS (SELECT 1 FROM entries WHERE digest = ?)", (old[0], old[0]))
+                self.db.execute("COMMIT")
+            except BaseException:
+                # the connection is shared, a transaction left open would make every later write fail
+                self.db.execute("ROLLBACK")
+                raise
+
+    # all (book, chapter) pairs in the cache
+    def keys(self):
+        with self.lock:
+            return [tuple(row) for row in self.db.execute("SELECT book, chapter FROM entries WHERE backend = ? AND version = ?",
+                                                          (self.backend, self.version))]
+
+    # the validators of a page after a "304 Not Modified" answer, the content stays the same
+    def touch(self, book, chapter, validators):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (self.backend, self.version, book, str(chapter), validators.get("etag"), validators.get("last_modified"), validators.get("fetched_at")))
+
+    def get_validators(self, book, chapter):
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified, fetched_at FROM validators WHERE backend = ? AND version = ? AND book = ? AND chapter = ?",
+                                  (self.backend, self.version, book, str(chapter))).fetchone()
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "fetched_at": row[2]}
+
+    # the validators of all pages by (book, chapter)
+    def validators(self):
+        with self.lock:
+            return {(row[0], row[1]): {"etag": row[2], "last_modified": row[3], "fetched_at": row[4]}
+                    for row in self.db.execute("SELECT book, chapter, etag, last_modified, fetched_at FROM validators WHERE backend = ? AND version = ?",
+                                               (self.backend, self.version))}
+
+    # remember that a page doesn't exist upstream
+    def mark_missing(self, book, chapter, status):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO missing VALUES (?, ?, ?, ?, ?, ?)",
+                            (self.backend, self.version, book, str(chapter), status, time.time()))
+
+    def get_missing(self, book, chapter):
+        with self.lock:
+            row = self.db.execute("SELECT status, fetched_at FROM missing WHERE backend = ? AND version = ? AND book = ? AND chapter = ?",
+                                  (self.backend, self.version, book, str(chapter))).fetchone()
+        if row is None:
+            return None
+        return {"status": row[0], "fetched_at": row[1]}
+
+    # all missing pages by (book, chapter)
+    def missing(self):
+        with self.lock:
+            return {(row[0], row[1]): {"status": row[2], "fetched_at": row[3]}
+                    for row in self.db.execute("SELECT book, chapter, status, fetched_at FROM missing WHERE backend = ? AND version = ?",
+                                               (self.backend, self.version))}
+
+    # the sha256 digests of all cached pages by (book, chapter), straight from the index
+    def digests(self):
+        with self.lock:
+            return {(row[0], row[1]): row[2] for row in self.db.execute("SELECT book, chapter, digest FROM entries WHERE backend = ? AND version = ?",
+                                                                         (self.backend, self.version))}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class LooseCache:
+
+    # the layout is the file name of a page in the cache directory, e.g. "{book}.{chapter}.json"
+    def __init__(self, path, layout):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.layout = layout
+        # to find the book and chapter of a file name again
+        self.pattern = re.compile("^" + re.escape(layout).replace(r"\{book\}", "(?P<book>.+)").replace(r"\{chapter\}", "(?P<chapter>.+?)") + "$")
+
+    def file(self, book, chapter):
+        return self.path / self.layout.format(book=book, chapter=chapter)
+
+    def get(self, book, chapter):
+        f = self.file(book, chapter)
+        if not f.exists():
+            return None
+        return f.read_bytes()
+
+    def put(self, book, chapter, data, validators=None):
+        self.file(book, chapter).write_bytes(data)
+        if validators:
+            self.touch(book, chapter, validators)
+        self.missing_file(book, chapter).unlink(missing_ok=True)
+
+    # the validators are kept next to the page, e.g. "Genesis.1.json.validators"
+    def validators_file(self, book, chapter):
+        f = self.file(book, chapter)
+        return f.with_name(f.name + ".validators")
+
+    def touch(self, book, chapter, validators):
+        self.validators_file(book, chapter).write_text(json.dumps(validators))
+
+    def get_validators(self, book, chapter):
+        f = self.validators_file(book, chapter)
+        if not f.exists():
+            return None
+        return json.loads(f.read_text())
+
+    def validators(self):
+        ret = {}
+        for book, chapter in self.keys():
+            v = self.get_validators(book, chapter)
+            if v is not None:
+                ret[(book, chapter)] = v
+        return ret
+
+    # pages that don't exist upstream are marked by a file like "Genesis.1.json.missing"
+    def missing_file(self, book, chapter):
+        f = self.file(book, chapter)
+        return f.with_name(f.name + ".missing")
+
+    def mark_missing(self, book, chapter, status):
+        self.missing_file(book, chapter).write_text(json.dumps({"status": status, "fetched_at": time.time()}))
+
+    def get_missing(self, book, chapter):
+        f = self.missing_file(book, chapter)
+        if not f.exists():
+            return None
+        return json.loads(f.read_text())
+
+    def missing(self):
+        ret = {}
+        for f in self.path.glob("*.missing"):
+            m = self.pattern.match(f.name[:-len(".missing")])
+            if m:
+                ret[(m.group("book"), m.group("chapter"))] = json.loads(f.read_text())
+        return ret
+
+    def keys(self):
+        ret = []
+        for f in self.path.iterdir():
+            m = self.pattern.match(f.name)
+            if m and f.is_file():
+                ret.append((m.group("book"), m.group("chapter")))
+        return ret
+
+    # the sha256 digests of all cached pages by (book, chapter). This needs to read all files.
+    def digests(self):
+        return {(book, chapter): digest_of(self.get(book, chapter)) for book, chapter in self.keys()}
+
+    def close(self):
+        pass
+
+# Does the cached page with the given validators have to be checked with the server again?
+# Everything is checked in refresh mode, otherwise only pages older than the ttl (in seconds).
+# Pages cached before validators were recorded don't expire, they are only checked in refresh mode.
+def needs_refresh(validators, ttl):
+    if settings["refresh"]:
+        return True
+    if settings["cache_ttl"] is not None:
+        ttl = settings["cache_ttl"]
+    if ttl is None or not validators or validators.get("fetched_at") is None:
+        return False
+    return time.time() - validators["fetched_at"] > ttl
+
+# the validators of a response, a "304 Not Modified" answer doesn't need to repeat the previous ones
+def validators_of(response, previous=None):
+    previous = previous or {}
+    return {"etag": response.headers.get("ETag") or previous.get("etag"),
+            "last_modified": response.headers.get("Last-Modified") or previous.get("last_modified"),
+            "fetched_at": time.time()}
+
+# the headers of a conditional request for a page with the given validators
+def conditional_headers(validators):
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+# Download a page into the store and return its content. If the page is cached already, the
+# request is conditional: the cached page is kept if the server answers "304 Not Modified",
+# and it is only replaced if the server sends it again. None is returned for a missing page.
+def download_page(store, book, chapter, url):
+
+    cached = store.get(book, chapter)
+    validators = (store.get_validators(book, chapter) if cached is not None else None) or {}
+
+    try:
+        response = get_response(url, conditional_headers(validators))
+    except HTTPError as e:
+        # the page doesn't exist (anymore)
+        if e.code in (404, 410):
+            store.mark_missing(book, chapter, e.code)
+            return None
+        raise
+
+    if response.status == 304 and cached is not None:
+        store.touch(book, chapter, validators_of(response, validators))
+        return cached
+
+    store.put(book, chapter, response.body, validators_of(response))
+    return response.body
+
+##################################################################
+##################################################################
+# Storage for the parsed chapters. They are stored by the digest of
+# the raw page they were parsed from, together with a stamp of the
+# parser. A new stamp means all old entries are ignored.
+
+class ParsedCache:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS parsed (digest TEXT, stamp TEXT, data BLOB, PRIMARY KEY (digest, stamp))")
+
+    def get(self, digest, stamp):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM parsed WHERE digest = ? AND stamp = ?", (digest, stamp)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, digest, stamp, value):
+        data = zlib.compress(json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode(), 6)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO parsed VALUES (?, ?, ?)", (digest, stamp, data))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+##################################################################
+##################################################################
+# An index of the versions offered by a backend, so a single version
+# (or all versions of a language) can be looked up without reading
+# the whole list. It is rebuilt whenever the list is downloaded again.
+
+class Catalogue:
+
+    columns = ["short_name", "id", "name", "english_name", "language", "books", "chapters", "verses"]
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (short_name TEXT PRIMARY KEY, id TEXT, name TEXT, english_name TEXT, language TEXT, "
+                        "books INTEGER, chapters INTEGER, verses INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_language ON versions (language)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+
+    # replace all versions at once (dicts with the keys in 'columns'), readers see either the old or the new list
+    def replace(self, versions, validators):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.execute("DELETE FROM versions")
+                self.db.executemany("INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [tuple(v.get(c) for c in self.columns) for v in versions])
+                self.db.execute("INSERT OR REPLACE INTO info VALUES ('validators', ?)", (json.dumps(validators),))
+                self.db.execute("COMMIT")
+            except BaseException:
+                # the old list stays, and the connection can still be written to
+                self.db.execute("ROLLBACK")
+                raise
+
+    # the validators of the list after a "304 Not Modified" answer, the versions stay the same
+    def touch(self, validators):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO info VALUES ('validators', ?)", (json.dumps(validators),))
+
+    def validators(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM info WHERE key = 'validators'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, short_name):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM versions WHERE short_name = ?", (short_name,)).fetchone()
+        return dict(zip(self.columns, row)) if row else None
+
+    # all versions in the order of the list, or only the ones of the given language
+    def versions(self, language=None):
+        with self.lock:
+            if language is None:
+                rows = self.db.execute("SELECT * FROM versions ORDER BY rowid").fetchall()
+            else:
+                rows = self.db.execute("SELECT * FROM versions WHERE language = ? ORDER BY rowid", (language,)).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM versions").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# The fetch plan of a version: the books that exist upstream with their number of chapters (in
+# canonical order), and when that was found out. Like a page, it expires after the ttl of the backend.
+
+def load_plan(backend, version):
+
+    try:
+        return json.loads(Path(f"cache/{backend}/{version}.plan.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def save_plan(backend, version, books):
+
+    plan = {"books": books, "fetched_at": time.time()}
+    f = Path(f"cache/{backend}/{version}.plan.json")
+    f.parent.mkdir(parents=True, exist_ok=True)
+    tmp = f.with_suffix(".tmp")
+    tmp.write_text(json.dumps(plan, indent=1), encoding="utf-8")
+    tmp.replace(f)
+    return plan
+
+# A stamp for a parser, made from its source files: any change to the code results in a new stamp
+def source_stamp(*files):
+    h = hashlib.sha256()
+    for f in files:
+        h.update(Path(f).read_bytes())
+    return h.hexdigest()[:16]
+
+##################################################################
+##################################################################
+# The stores are opened once and then shared by everyone in the process
+
+stores = {}
+stores_lock = Lock()
+
+def open_cache(backend, version, layout):
+
+    with stores_lock:
+        key = (settings["cache_store"], backend, version)
+        if key not in stores:
+            if settings["cache_store"] == "loose":
+                stores[key] = LooseCache(Path(f"cache/{backend}/{version}"), layout)
+            else:
+                stores[key] = PackCache(Path(f"cache/{backend}/{version}.sqlite"), backend, version)
+                # pages cached in the loose layout before are moved into the pack, instead of downloading them again
+                legacy = Path(f"cache/{backend}/{version}")
+                if legacy.is_dir():
+                    move_loose_files(legacy, stores[key], layout, False)
+        return stores[key]
+
+def open_catalogue(backend):
+
+    with stores_lock:
+        key = ("catalogue", backend)
+        if key not in stores:
+            stores[key] = Catalogue(Path(f"cache/{backend}/catalogue.sqlite"))
+        return stores[key]
+
+def open_parsed_cache(backend):
+
+    with stores_lock:
+        key = ("parsed", backend)
+        if key not in stores:
+            stores[key] = ParsedCache(Path(f"cache/{backend}/parsed.sqlite"))
+        return stores[key]
+
+##################################################################
+##################################################################
+# Move the loose files of all versions of a backend into pack files.
+# Files are only deleted after their content was read back from the pack.
+
+def migrate_cache(backend, layout, verbose):
+
+    root = Path(f"cache/{backend}")
+    if not root.exists():
+        return
+
+    for version_dir in sorted(root.iterdir()):
+
+        if not version_dir.is_dir():
+            continue
+
+        version = version_dir.name
+        pack = PackCache(root / f"{version}.sqlite", backend, version)
+        move_loose_files(version_dir, pack, layout, verbose)
+        pack.close()
+
+def move_loose_files(version_dir, pack, layout, verbose):
+
+    loose = LooseCache(version_dir, layout)
+
+    keys = loose.keys()
+    print(f"  {pack.backend}/{pack.version}: moving {len(keys)} cached files")
+
+    for book, chapter in keys:
+        data = loose.get(book, chapter)
+        # another run moved it already
+        if data is None:
+            continue
+        pack.put(book, chapter, data, loose.get_validators(book, chapter))
+        if pack.get(book, chapter) != data:
+            raise RuntimeError(f"Cache migration failed for {pack.backend}/{pack.version}: {book} {chapter}")
+        loose.file(book, chapter).unlink(missing_ok=True)
+        loose.validators_file(book, chapter).unlink(missing_ok=True)
+        if verbose:
+            print(f"    -> {book} {chapter}")
+
+    for book, chapter in loose.missing():
+        pack.mark_missing(book, chapter, loose.get_missing(book, chapter)["status"])
+        loose.missing_file(book, chapter).unlink(missing_ok=True)
+
+    # only remove the directory if nothing else was in it
+    if not any(version_dir.iterdir()):
+        version_dir.rmdir()
+
+##################################################################
+##################################################################
+# Build manifests: what went into the last build of a module and what
+# came out of each stage (chapters, OSIS, zip file). A rebuild skips
+# every stage whose input is unchanged. Rendered OSIS chapters are kept
+# in a fragment cache by the digest of their content, and compiled
+# modules by the digest of their OSIS file and the osis2mod version.
+
+def build_path(name):
+    return Path(f"cache/builds/{name}")
+
+def compiled_path(key):
+    return Path(f"cache/builds/compiled/{key}")
+
+def load_build_manifest(name):
+
+    try:
+        return json.loads((build_path(name) / "manifest.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def save_build_manifest(name, manifest):
+
+    f = build_path(name) / "manifest.json"
+    f.parent.mkdir(parents=True, exist_ok=True)
+    # write a new file and replace the old one, so an interrupted build never leaves half a manifest behind
+    tmp = f.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, indent=1), encoding="utf-8")
+    tmp.replace(f)
+
+def file_digest(path):
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def open_fragment_cache():
+
+    with stores_lock:
+        key = ("fragments",)
+        if key not in stores:
+            stores[key] = ParsedCache(Path("cache/builds/fragments.sqlite"))
+        return stores[key]
@@ -0,0 +1,123 @@
+import re
+from array import array
+
+##################################################################
+##################################################################
+# A compact representation of a chapter
+#
+# The backends deliver every chapter as a dict with its book, its
+# chapter number and its content, a list of strings ("---" for a new
+# section, "## title", "# title") and [verse, text] lists. A Chapter
+# holds the same as a flat list of records: the kind of each record
+# in a byte array, and one value per record in a list. Titles, verses
+# and lines of poetry are followed by the pieces of their text, with
+# cross references and footnotes already split out of it. So the
+# content is only looked at once, when it is converted, and a chapter
+# needs a lot fewer Python objects while it waits to be rendered.
+
+# the kinds of records, and what their value is
+SECTION = 0        # a new section, no value
+CHAPTER_TITLE = 1  # a title of the chapter, no value (its text follows)
+SECTION_TITLE = 2  # a title in the section, no value (its text follows)
+VERSE = 3          # a verse, the verse number (its text follows)
+POETRY = 4         # a verse of poetry, the verse number (its lines follow)
+LINE = 5           # a line of poetry, its indentation level (its text follows)
+TEXT = 6           # a piece of text
+XREF = 7           # a cross reference, the content of its |[|...|]| marker
+FOOTNOTE = 8       # a footnote, the content of its |||...||| marker
+
+# Cross references look like |[|book|chapter|verse|references|]| and
+# footnotes like |||book|chapter|footnote|||
+marker_pattern = re.compile(r"\|\[\|(.*?)\|\]\||\|\|\|(.*?)\|\|\|", re.DOTALL)
+
+class Chapter:
+
+    __slots__ = ("book", "chapter", "kinds", "values")
+
+    def __init__(self, book, chapter):
+        self.book = book
+        self.chapter = chapter
+        self.kinds = array("B")
+        self.values = []
+
+    def add(self, kind, value=None):
+        self.kinds.append(kind)
+        self.values.append(value)
+
+    # add the pieces of a text: plain text, cross references and footnotes
+    def add_text(self, text):
+
+        if "|" not in text:
+            if text:
+                self.add(TEXT, text)
+            return
+
+        pos = 0
+        for m in marker_pattern.finditer(text):
+            if m.start() > pos:
+                self.add(TEXT, text[pos:m.start()])
+            if m.group(1) is not None:
+                self.add(XREF, m.group(1))
+            else:
+                self.add(FOOTNOTE, m.group(2))
+            pos = m.end()
+        if pos < len(text):
+            self.add(TEXT, text[pos:])
+
+    # convert a chapter in the format of the backends
+    @classmethod
+    def from_entry(cls, entry):
+
+        if isinstance(entry, cls):
+            return entry
+
+        chapter = cls(entry['book'], entry['chapter'])
+        # verses and section titles go into a section, one is started if there is none yet
+        in_section = False
+
+        for c in entry['content']:
+
+            first = (c[0] if type(c) == list else c).lstrip()
+            second = (c[1] if type(c) == list else "").lstrip()
+
+            if first == "":
+                continue
+
+            if first == "---":
+                chapter.add(SECTION)
+                in_section = True
+                continue
+
+            if first.startswith("## "):
+                chapter.add(CHAPTER_TITLE)
+                chapter.add_text(first.split("# ")[1].strip())
+                chapter.add(SECTION)
+                in_section = True
+                continue
+
+            if not in_section:
+                chapter.add(SECTION)
+                in_section = True
+
+            if first.startswith("#"):
+                chapter.add(SECTION_TITLE)
+                chapter.add_text(first.split("# ")[1].strip())
+
+            # no verse data -> skip
+            elif second == "":
+                continue
+
+            # poetry: one line per line of text, indented by four spaces per level
+            elif "\n" in second:
+                chapter.add(POETRY, first)
+                for p in second.lstrip("\n").split("\n"):
+                    if p.strip() == "":
+                        continue
+                    chapter.add(LINE, (len(p) - len(p.lstrip(' ')) + 3) // 4)
+                    chapter.add_text(p.strip())
+
+            else:
+                chapter.add(VERSE, first)
+                chapter.add_text(second)
+
+        return chapter
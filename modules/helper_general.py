@@ -1,25 +1,205 @@
-from urllib.error import URLError
-from urllib.request import urlopen
+from urllib.error import URLError, HTTPError
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from threading import Lock, BoundedSemaphore
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
 import re
-from time import sleep
-from random import randint
+from time import sleep, monotonic
+from .helper_http import http_client
+
+# Settings shared by SID and all backends. They can be changed by sword.py from the command line.
+settings = {"workers": 8,           # the maximum number of parallel downloads of a backend
+            "rate_limit": 10.0,     # the maximum number of requests per second to the same host
+            "processes": os.cpu_count() or 1,  # the number of processes for CPU-bound work like parsing
+            "whole_book": False,    # request whole books instead of single chapters (if the backend supports it)
+            "chapters_per_request": 0,  # the maximum number of chapters per request in whole-book mode (0: no limit)
+            "cache_store": "pack",  # how downloaded pages are cached: "pack" (one file per version) or "loose" (one file per page)
+            "max_per_host": 8,      # the maximum number of requests in flight to the same host, over all builds of a batch
+            "progress": True,       # show progress bars (they are turned off when several builds run at once)
+            "process_pool": None,   # a process pool shared by all builds of a batch, used instead of creating one per build
+            "incremental": True,    # reuse the results of the last build of a module where its inputs did not change
+            "refresh": False,       # check all cached pages with the server again, instead of only the expired ones
+            "cache_ttl": None,      # seconds after which a cached page is checked again (None: the default of the backend)
+            "bulk": True,           # download whole translations at once where the backend supports it
+            "check_osis": False,    # check the structure of the OSIS xml (verse order, duplicate ids, ...) while it is written
+            "html_parser": "lxml"}  # the parser for the HTML of downloaded pages: "lxml" (fast, if installed) or "bs4" (BeautifulSoup)
 
 def remove_html_tags(data):
     p = re.compile(r'<.*?>')
     return p.sub('', data)
 
-def wait_shortly():
-    sleep(randint(1,10)/10)
+##################################################################
+# A rate limiter for the requests to one host, shared by all threads.
+#
+# Requests are spaced out evenly at the current rate. The rate adapts to
+# the server (additive increase, multiplicative decrease): it grows a little
+# with every fast and successful response, up to the maximum rate, and it
+# is cut when the server is throttling us (429/503) or responses get slower.
+
+MIN_RATE = 0.2          # never fewer requests per second than this
+RATE_INCREASE = 0.1     # requests per second added after every successful response
+LATENCY_FACTOR = 2.0    # responses are slow once they take this much longer than the fastest ones
+LATENCY_FLOOR = 0.05    # responses faster than this many seconds are never slow
+
+class RateLimiter:
+
+    def __init__(self, max_rate):
+        # a maximum rate of 0 means no limit
+        self.max_rate = max_rate
+        self.rate = max(min(MIN_RATE, max_rate), max_rate/4) if max_rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.latency = None     # moving average of the response times
+        self.fastest = None     # the response time of a fast response, slowly following the actual ones
+        self.last_decrease = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.lock = Lock()
+
+    # reserve the next slot for a request, returns the time to wait for it
+    def _reserve(self):
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0/self.rate
+            return slot - now
+
+    # block until the next request to this host is allowed
+    def wait(self):
+        delay = self._reserve()
+        if delay > 0:
+            sleep(delay)
+
+    # cut the rate, at most once a second: the responses still on their way were requested at the old rate
+    def _decrease(self, factor):
+        now = monotonic()
+        if self.max_rate <= 0 or now - self.last_decrease < 1.0:
+            return
+        self.last_decrease = now
+        self.rate = max(min(MIN_RATE, self.max_rate), self.rate*factor)
+
+    # a response arrived after the given number of seconds
+    def success(self, latency):
+        with self.lock:
+            self.requests += 1
+            self.latency = latency if self.latency is None else 0.8*self.latency + 0.2*latency
+            self.fastest = latency if self.fastest is None else min(latency, self.fastest + 0.01*(latency - self.fastest))
+            if self.latency > LATENCY_FLOOR and self.latency > LATENCY_FACTOR*self.fastest:
+                self._decrease(0.9)
+            elif self.max_rate > 0:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    # the server asked us to slow down, and maybe to pause for some seconds
+    def throttle(self, pause=None):
+        with self.lock:
+            self.requests += 1
+            self.throttled += 1
+            self._decrease(0.5)
+            if pause:
+                self.next_slot = max(self.next_slot, monotonic() + pause)
+
+    # lower the maximum rate, e.g. to be polite to a server
+    def limit(self, max_rate):
+        with self.lock:
+            if max_rate > 0 and (self.max_rate <= 0 or max_rate < self.max_rate):
+                self.max_rate = max_rate
+                self.rate = min(self.rate, max_rate) if self.rate > 0 else max_rate/4
+
+    def metrics(self):
+        with self.lock:
+            return {"rate": self.rate,
+                    "max_rate": self.max_rate,
+                    "requests": self.requests,
+                    "throttled": self.throttled,
+                    "latency": self.latency}
+
+rate_limiters = {}
+rate_limiters_lock = Lock()
+
+# A helper function that returns the (shared) rate limiter for the host of the given url
+def get_rate_limiter(url):
+    host = urlparse(url).netloc
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = RateLimiter(settings["rate_limit"])
+        return rate_limiters[host]
+
+# The current state of the rate limiters of all hosts
+def rate_limiter_metrics():
+    with rate_limiters_lock:
+        limiters = dict(rate_limiters)
+    return {host: limiters[host].metrics() for host in limiters}
+
+def print_rate_metrics():
+    for host, m in rate_limiter_metrics().items():
+        latency = f", {m['latency']*1000:.0f} ms per response" if m['latency'] is not None else ""
+        print(f"  {host}: {m['requests']} requests ({m['throttled']} throttled), now {m['rate']:.1f} of at most {m['max_rate']:.1f} per second{latency}")
+
+host_slots = {}
+host_slots_lock = Lock()
+
+# A helper function that returns the semaphore limiting the number of parallel requests to the host of the given url
+def get_host_slots(url):
+    host = urlparse(url).netloc
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = BoundedSemaphore(max(1, settings["max_per_host"]))
+        return host_slots[host]
 
 # A helper function that returns the contents of a web page.
+# The connections to the server are kept open and reused by the shared http_client.
 def get_page(url, retry_count=3, retry_delay=2):
+    return get_response(url, retry_count=retry_count, retry_delay=retry_delay).body
+
+# A helper function that returns the full response (status, headers and body) for a web page.
+# Extra request headers can be given, e.g. to make a conditional request.
+def get_response(url, headers=None, retry_count=3, retry_delay=2):
+    return retry_request(http_client.request, url, headers, retry_count, retry_delay)
+
+# A helper function that opens a (large) web page to read it piece by piece, see HttpClient.open.
+# Only opening the page is retried, the caller has to handle errors while reading it.
+def open_page(url, headers=None, retry_count=3, retry_delay=2):
+    return retry_request(http_client.open, url, headers, retry_count, retry_delay)
+
+# a server is never waited for longer than this many seconds before asking again
+MAX_RETRY_AFTER = 300
+
+def retry_request(request, url, headers, retry_count, retry_delay):
     # Cap the values to ensure the function isn't suspended for an eternity, but still attempts at least once
     delay_multiplier = 2
+    # Every request (also when retrying) waits for the rate limiter of the host, and tells it how it went
+    limiter = get_rate_limiter(url)
     # The extra addition to the range end is to account for the initial request
     for retry in range(0, retry_count + 1):
+        limiter.wait()
         try:
-            with urlopen(url) as response:
-                return response.read()
+            with get_host_slots(url):
+                start = monotonic()
+                response = request(url, headers)
+            limiter.success(monotonic() - start)
+            return response
+        except HTTPError as exception:
+            if exception.code in (429, 503):
+                limiter.throttle(retry_after(exception))
+            else:
+                # any other answer (like "404 Not Found") shows how fast the server is just as well
+                limiter.success(monotonic() - start)
+            # asking again won't change the answer to a bad request (like "404 Not Found"),
+            # except for "429 Too Many Requests"
+            if 400 <= exception.code < 500 and exception.code != 429:
+                raise exception
+            if retry < retry_count:
+                # the server might tell us how long to wait
+                delay = retry_after(exception)
+                sleep(min(MAX_RETRY_AFTER, delay if delay is not None else retry_delay))
+                retry_delay *= delay_multiplier
+                continue
+            raise exception
         except URLError as exception:
             if retry < retry_count:
                 sleep(retry_delay)
@@ -27,6 +207,46 @@ def get_page(url, retry_count=3, retry_delay=2):
                 continue
             raise exception
 
+# The number of seconds to wait given in the Retry-After header of an error response, if any
+def retry_after(exception):
+    value = exception.headers.get("Retry-After") if exception.headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # it can also be a date
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# A helper function that creates a pool of worker processes for CPU-bound work.
+# The processes are forked right away, before the caller starts any threads of its own.
+# If forking is not available (or no processes are wanted) None is returned and the
+# caller is expected to do the work in its own threads.
+def create_process_pool(processes):
+    if processes < 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork"))
+    list(pool.map(int, range(processes)))
+    return pool
+
+# A helper function that connects two stages of work: the result of each of the given futures is
+# handed to submit() as soon as it is available, which starts the second stage for it and returns
+# a new future. The results of the second stage are yielded in the order of the given futures.
+def chain_in_order(futures, submit):
+    finished = Queue()
+    for i, f in enumerate(futures):
+        f.add_done_callback(lambda f, i=i: finished.put(i))
+    second = {}
+    for i in range(len(futures)):
+        while i not in second:
+            j = finished.get()
+            second[j] = submit(futures[j].result(), j)
+        yield second.pop(i).result()
+
 # A helper function to convert certain punctuation characters from Unicode to ASCII
 def unicode_to_ascii_punctuation(text):
     punctuation_map = text.maketrans('“‘—’”', '"\'-\'"')
@@ -47,6 +267,8 @@ def printProgressBar(iteration, total, prefix = '', suffix = '', decimals = 1, l
         fill        - Optional  : bar fill character (Str)
         printEnd    - Optional  : end character (e.g. "\r", "\r\n") (Str)
     """
+    if not settings["progress"]:
+        return
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filledLength = int(length * iteration // total)
     bar = fill * filledLength + '-' * (length - filledLength)
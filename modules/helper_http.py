@@ -0,0 +1,262 @@
+import http.client
+import io
+import ssl
+import sys
+import zlib
+from threading import Lock
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlsplit, urljoin
+from urllib.request import getproxies, urlopen, Request
+
+# brotli is optional: responses are only requested brotli-compressed if a decoder is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+##################################################################
+##################################################################
+# A small HTTP client that keeps connections to each host open and
+# reuses them for the following requests (keep-alive). This saves a
+# new TCP and TLS handshake for almost every chapter we download.
+
+# same User-Agent that urllib uses, so servers see the same client as before
+USER_AGENT = f"Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}"
+
+MAX_REDIRECTS = 5
+
+class HttpResponse:
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+# A response whose body is read (and decompressed) piece by piece, like a file.
+# 'done' is called once the stream is closed, with whether the body was read completely.
+class HttpStream:
+
+    def __init__(self, url, status, headers, raw, encoding=None, done=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.raw = raw
+        encoding = (encoding or "identity").strip().lower()
+        # gzip as well as zlib (deflate) data is recognized by its header
+        self.decoder = zlib.decompressobj(32 + zlib.MAX_WBITS) if encoding in ("gzip", "x-gzip", "deflate") else None
+        self.done = done
+        self.buffer = bytearray()
+        self.finished = False
+        self.closed = False
+
+    def _fill(self, size):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            try:
+                chunk = self.raw.read(1 << 16)
+            except (http.client.HTTPException, OSError) as e:
+                self.close()
+                raise URLError(e)
+            if not chunk:
+                if self.decoder:
+                    self.buffer += self.decoder.flush()
+                self.finished = True
+                break
+            self.buffer += self.decoder.decompress(chunk) if self.decoder else chunk
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.done:
+                self.done(self.finished)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class HttpClient:
+
+    def __init__(self, timeout=30, max_idle=8):
+        self.timeout = timeout
+        # the maximum number of idle connections kept open per host
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = Lock()
+        self.ssl_context = ssl.create_default_context()
+        self.encodings = "gzip, deflate" + (", br" if brotli else "")
+
+    # get an open connection to the given host, or create a new one
+    def _connection(self, scheme, host):
+        with self.lock:
+            pool = self.idle.get((scheme, host))
+            if pool:
+                return pool.pop(), True
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout, context=self.ssl_context), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    # hand a connection back for the next request to the same host
+    def _release(self, scheme, host, conn):
+        with self.lock:
+            pool = self.idle.setdefault((scheme, host), [])
+            if len(pool) < self.max_idle:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _decode(self, body, encoding):
+        encoding = (encoding or "identity").strip().lower()
+        if encoding == "gzip" or encoding == "x-gzip":
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if encoding == "deflate":
+            # some servers send raw deflate data without the zlib header
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        if encoding == "br" and brotli:
+            return brotli.decompress(body)
+        return body
+
+    # send a single GET request, retrying once on a fresh connection if a kept-alive one was closed by the server
+    def _start(self, scheme, host, path, headers):
+        while True:
+            conn, reused = self._connection(scheme, host)
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise URLError(e)
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                raise URLError(e)
+
+    # the connection of a completely read response can be used again
+    def _finish(self, scheme, host, conn, response, complete=True):
+        if complete and not response.will_close:
+            self._release(scheme, host, conn)
+        else:
+            conn.close()
+
+    def _send(self, scheme, host, path, headers):
+        conn, response = self._start(scheme, host, path, headers)
+        try:
+            body = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise URLError(e)
+        self._finish(scheme, host, conn, response)
+        return response, body
+
+    def _headers(self, headers, encodings):
+        request_headers = {"User-Agent": USER_AGENT,
+                           "Accept-Encoding": encodings,
+                           "Connection": "keep-alive"}
+        request_headers.update(headers or {})
+        return request_headers
+
+    def _path(self, parts):
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+        return path
+
+    # Request the given url. Raises an HTTPError for error responses, and an URLError if the server
+    # could not be reached, just like urllib does. A "304 Not Modified" answer to a conditional
+    # request is returned as a response with an empty body.
+    def request(self, url, headers=None):
+
+        # proxies are left to urllib
+        if getproxies():
+            try:
+                with urlopen(Request(url, headers=headers or {}), timeout=self.timeout) as response:
+                    return HttpResponse(response.url, response.status, response.headers, response.read())
+            except HTTPError as e:
+                # urllib treats "304 Not Modified" as an error, we don't
+                if e.code == 304:
+                    return HttpResponse(url, 304, e.headers, b"")
+                raise
+
+        for redirect in range(MAX_REDIRECTS + 1):
+
+            parts = urlsplit(url)
+            response, body = self._send(parts.scheme, parts.netloc, self._path(parts), self._headers(headers, self.encodings))
+            body = self._decode(body, response.getheader("Content-Encoding"))
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                url = urljoin(url, response.getheader("Location"))
+                continue
+
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+            return HttpResponse(url, response.status, response.headers, body)
+
+        raise URLError(f"Too many redirects: {url}")
+
+    # Request the given url like request(), but return an HttpStream to read the body piece by piece.
+    # This is meant for large downloads. It has to be closed (or used in a with statement).
+    def open(self, url, headers=None):
+
+        if getproxies():
+            try:
+                response = urlopen(Request(url, headers=headers or {}), timeout=self.timeout)
+            except HTTPError as e:
+                if e.code == 304:
+                    return HttpStream(url, 304, e.headers, io.BytesIO(b""))
+                raise
+            return HttpStream(response.url, response.status, response.headers, response, done=lambda complete: response.close())
+
+        for redirect in range(MAX_REDIRECTS + 1):
+
+            parts = urlsplit(url)
+            # brotli can't be decompressed piece by piece here, so it is not asked for
+            conn, response = self._start(parts.scheme, parts.netloc, self._path(parts), self._headers(headers, "gzip, deflate"))
+
+            if response.status in (301, 302, 303, 307, 308) or response.status >= 400 or response.status == 304:
+                try:
+                    body = self._decode(response.read(), response.getheader("Content-Encoding"))
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    raise URLError(e)
+                self._finish(parts.scheme, parts.netloc, conn, response)
+                if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                    url = urljoin(url, response.getheader("Location"))
+                    continue
+                if response.status >= 400:
+                    raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+                return HttpStream(url, response.status, response.headers, io.BytesIO(body))
+
+            def done(complete, scheme=parts.scheme, host=parts.netloc, conn=conn, response=response):
+                self._finish(scheme, host, conn, response, complete)
+
+            return HttpStream(url, response.status, response.headers, response, response.getheader("Content-Encoding"), done)
+
+        raise URLError(f"Too many redirects: {url}")
+
+    # close all idle connections
+    def close(self):
+        with self.lock:
+            pools = list(self.idle.values())
+            self.idle = {}
+        for pool in pools:
+            for conn in pool:
+                conn.close()
+
+# the client shared by all backends
+http_client = HttpClient()
@@ -0,0 +1,215 @@
+import re
+from modules.helper_booknames import bible_books_chapters, convert_bookname_to_osis
+
+# lxml is optional, the parser of the standard library does the same (a bit slower)
+try:
+    from lxml import etree
+except ImportError:
+    from xml.etree import ElementTree as etree
+
+##################################################################
+##################################################################
+# Streaming structure check of OSIS files
+#
+# The xml is fed to a pull parser piece by piece while it is written
+# (or read from a file), and every book, chapter and verse is removed
+# again once it has been checked. So only the current chapter is held
+# in memory, no matter how large the file is. Checked are:
+#
+#   - the xml is well-formed
+#   - chapters belong to their book and verses to their chapter
+#   - books, chapters and verses (and notes) have unique osisIDs
+#   - chapters and verses are in ascending order
+#   - notes are not nested, and no cross reference or footnote marker
+#     was left over in the text (i.e. it was never closed)
+#
+# Errors are reported with the book, chapter and verse they occur in.
+
+OSIS_NS = "{http://www.bibletechnologies.net/2003/OSIS/namespace}"
+
+# leftovers of the placeholders of cross references and footnotes
+unclosed_markers = ("|[|", "|]|", "|||")
+
+number_pattern = re.compile(r"\d+")
+
+osis_id_pattern = re.compile(r'<(?:verse|chapter|div type="book") osisID="([^"]*)"')
+
+osis2book = {convert_bookname_to_osis(book): book for book in bible_books_chapters}
+
+# "Gen.1.3" -> "Genesis 1:3"
+def osis_location(osis_id):
+
+    parts = osis_id.split("!")[0].split(".")
+    ret = osis2book.get(parts[0], parts[0])
+    if len(parts) > 1:
+        ret += f" {parts[1]}"
+    if len(parts) > 2:
+        ret += f":{'.'.join(parts[2:])}"
+    return ret
+
+def leading_number(text):
+    m = number_pattern.match(text)
+    return int(m.group()) if m else None
+
+class OsisChecker:
+
+    def __init__(self):
+        self.parser = etree.XMLPullParser(events=("start", "end"))
+        self.stack = []
+        self.errors = []
+        # after a syntax error, nothing more can be checked
+        self.broken = False
+        # the number of lines fed so far
+        self.lines = 0
+        self.books = set()
+        self.book = None
+        self.start_book(None)
+
+    def start_book(self, book):
+        self.book = book
+        self.chapters = set()
+        self.chapter = None
+        self.chapter_number = None
+        self.start_chapter(None)
+
+    def start_chapter(self, chapter):
+        self.chapter = chapter
+        # the osisIDs of the chapter, verses and notes have to be unique within their chapter
+        self.ids = set()
+        self.verse = None
+        self.verse_number = None
+        self.note = None
+
+    def location(self):
+        current = self.verse or self.chapter or self.book
+        return osis_location(current) if current else "Header"
+
+    def error(self, message):
+        self.errors.append(f"{self.location()}: {message}")
+
+    def feed(self, text):
+
+        if self.broken:
+            return
+
+        try:
+            self.parser.feed(text)
+            for event, elem in self.parser.read_events():
+                tag = elem.tag.replace(OSIS_NS, "") if isinstance(elem.tag, str) else ""
+                if event == "start":
+                    self.stack.append(elem)
+                    self.start(tag, elem)
+                else:
+                    self.stack.pop()
+                    self.end(tag, elem)
+        except SyntaxError as e:
+            self.syntax_error(e, text)
+            return
+
+        self.lines += text.count("\n" if isinstance(text, str) else b"\n")
+
+    # The parser stops at a syntax error before the events of the text fed last are read,
+    # so the location is taken from the last osisID in that text before the error.
+    def syntax_error(self, e, text):
+
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", "replace")
+        line = e.position[0] if getattr(e, "position", None) else e.lineno
+        if line:
+            text = "\n".join(text.split("\n")[:max(0, line - self.lines)])
+
+        ids = osis_id_pattern.findall(text)
+        if ids:
+            self.verse = ids[-1]
+
+        self.error(f"The XML is not well-formed ({e})")
+        self.broken = True
+
+    # returns the list of all errors found
+    def close(self):
+
+        if not self.broken:
+            try:
+                self.parser.close()
+            except SyntaxError as e:
+                self.syntax_error(e, "")
+
+        return self.errors
+
+    def start(self, tag, elem):
+
+        osis_id = elem.get("osisID", "")
+
+        if tag == "div" and elem.get("type") == "book":
+
+            self.start_book(osis_id)
+            if osis_id in self.books:
+                self.error("The book occurs more than once")
+            self.books.add(osis_id)
+
+        elif tag == "chapter":
+
+            previous = self.chapter_number
+            self.start_chapter(osis_id)
+            self.chapter_number = leading_number(osis_id.split(".")[-1])
+
+            if self.book is None or not osis_id.startswith(self.book + "."):
+                self.error(f"The chapter is not part of the book {self.book}")
+            if osis_id in self.chapters:
+                self.error("The chapter occurs more than once")
+            elif self.chapter_number is not None and previous is not None and self.chapter_number <= previous:
+                self.error(f"The chapter is out of order, it follows chapter {previous}")
+            self.chapters.add(osis_id)
+
+        elif tag == "verse":
+
+            previous = self.verse_number
+            self.verse = osis_id
+            self.verse_number = leading_number(osis_id.split(".")[-1])
+
+            if self.chapter is None or not osis_id.startswith(self.chapter + "."):
+                self.error(f"The verse is not part of the chapter {self.chapter}")
+            if osis_id in self.ids:
+                self.error("The verse occurs more than once")
+            elif self.verse_number is not None and previous is not None and self.verse_number <= previous:
+                self.error(f"The verse is out of order, it follows verse {previous}")
+            self.ids.add(osis_id)
+
+        elif tag == "note":
+
+            if self.note is not None:
+                self.error("A note is nested in another note")
+            self.note = elem
+            if osis_id:
+                if osis_id in self.ids:
+                    self.error(f"The note {osis_id} occurs more than once")
+                self.ids.add(osis_id)
+
+    def end(self, tag, elem):
+
+        if tag == "note":
+            self.note = None
+
+        elif tag == "verse":
+            text = "".join(elem.itertext())
+            if any(m in text for m in unclosed_markers):
+                self.error("A cross reference or footnote was not closed")
+
+        # checked elements are dropped, to keep the memory bounded
+        if tag in ("header", "chapter") or (tag == "div" and elem.get("type") == "book"):
+            if self.stack:
+                self.stack[-1].remove(elem)
+
+# check an OSIS file that was already written, it is read in pieces
+def check_osis(path):
+
+    checker = OsisChecker()
+
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            checker.feed(chunk)
+
+    return checker.close()
@@ -0,0 +1,119 @@
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+##################################################################
+##################################################################
+# Writing ZIP files
+#
+# The entries are compressed in parallel by a pool of threads (zlib
+# releases the GIL while it compresses), and written in their order
+# as soon as they are ready. All sizes are known before an entry is
+# written, so the archive can be written to any file object, even
+# one that can't seek (like a pipe or a socket).
+#
+# The osis2mod data files (*.bzz) are compressed already, they are
+# stored as they are. All other files are deflated, unless that does
+# not make them smaller. Archives larger than 4 GB (zip64) are not
+# supported, no module gets anywhere near that.
+
+# file extensions of files that are stored without compression
+STORED_EXTENSIONS = (".bzz",)
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# the layout of the headers, the same as the zipfile module uses
+local_header = struct.Struct("<4s2B4HL2L2H")
+central_header = struct.Struct("<4s4B4HL2L5H2L")
+end_of_central_directory = struct.Struct("<4s4H2LH")
+
+# files in zip files have the date and time in MS-DOS format
+def dos_date_time(timestamp):
+
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 1 << 5 | 1, 0
+    return (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+# the files and directories below the given sub directories, with their names in the archive (relative to root_dir)
+def zip_entries(root_dir, subdirs):
+
+    entries = []
+    for subdir in subdirs:
+        for dirname, dirs, files in os.walk(Path(root_dir) / subdir):
+            dirs.sort()
+            entries.append((dirname, os.path.relpath(dirname, root_dir).replace(os.sep, "/") + "/"))
+            for filename in sorted(files):
+                path = os.path.join(dirname, filename)
+                entries.append((path, os.path.relpath(path, root_dir).replace(os.sep, "/")))
+    return entries
+
+# read and compress a single entry, this runs in the threads of the pool
+def compress_entry(path, arcname):
+
+    st = os.stat(path)
+    date, mtime = dos_date_time(st.st_mtime)
+
+    if arcname.endswith("/"):
+        return {"name": arcname, "data": b"", "method": ZIP_STORED, "crc": 0, "size": 0,
+                "date": date, "time": mtime, "attr": (st.st_mode & 0xFFFF) << 16 | 0x10}
+
+    with open(path, "rb") as f:
+        data = f.read()
+    size = len(data)
+    crc = zlib.crc32(data)
+    method = ZIP_STORED
+
+    if not arcname.endswith(STORED_EXTENSIONS):
+        # raw deflate data, without the zlib header
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < size:
+            data = deflated
+            method = ZIP_DEFLATED
+
+    if size >= 0xFFFFFFFF:
+        raise ValueError(f"{arcname} is too large for a ZIP file without zip64")
+
+    return {"name": arcname, "data": data, "method": method, "crc": crc, "size": size,
+            "date": date, "time": mtime, "attr": (st.st_mode & 0xFFFF) << 16}
+
+# Write a ZIP file of the given entries (path and name in the archive) to the file object f
+def write_zip(f, entries, workers=4):
+
+    central = []
+    offset = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+
+        for entry in pool.map(lambda e: compress_entry(*e), entries):
+
+            try:
+                name = entry["name"].encode("ascii")
+                flags = 0
+            except UnicodeEncodeError:
+                # the name is utf-8 encoded
+                name = entry["name"].encode("utf-8")
+                flags = 0x800
+
+            fields = (flags, entry["method"], entry["time"], entry["date"], entry["crc"], len(entry["data"]), entry["size"], len(name))
+
+            # needs version 2.0 to extract, no extra field
+            f.write(local_header.pack(b"PK\003\004", 20, 0, *fields, 0))
+            f.write(name)
+            f.write(entry["data"])
+
+            # made by version 2.0 on unix, needs version 2.0 to extract, no extra field, comment or internal attributes
+            central.append(central_header.pack(b"PK\001\002", 20, 3, 20, 0, *fields, 0, 0, 0, 0, entry["attr"], offset) + name)
+            offset += local_header.size + len(name) + len(entry["data"])
+
+            if offset >= 0xFFFFFFFF:
+                raise ValueError("The ZIP file is too large without zip64")
+
+    directory = b"".join(central)
+    f.write(directory)
+    f.write(end_of_central_directory.pack(b"PK\005\006", 0, 0, len(central), len(central), len(directory), offset, 0))
@@ -1,11 +1,21 @@
 import os
 from pathlib import Path
 import shutil
-import math
+import re
+import functools
 import subprocess
-import xml.etree.ElementTree as EleTree
-from xml.dom import minidom
+import asyncio
+import tempfile
+import threading
+import json
+from collections import deque
+from concurrent.futures import Future
 from modules.helper_booknames import *
+from modules.helper_general import settings, create_process_pool
+from modules.helper_cache import digest_of, source_stamp, file_digest, build_path, compiled_path, load_build_manifest, save_build_manifest, open_fragment_cache
+from modules.helper_osis import OsisChecker
+from modules.helper_chapter import *
+from modules.helper_zip import zip_entries, write_zip
 
 ##################################################################
 ##################################################################
@@ -13,326 +23,395 @@ from modules.helper_booknames import *
 
 backends = list(filter(str.strip, [fn[8:-3] if fn.startswith("backend_") else "" for fn in next(os.walk('./modules'), (None, None, []))[2]]))
 
+# import the module of the given backend
+def load_backend(backend):
+    return __import__(f'modules.backend_{backend.replace(".","")}', fromlist=[''])
+
 ##################################################################
 ##################################################################
-# condense reference ranges
-
-def condense_reference_ranges(ref):
-
-    if not "-" in ref:
-        return ref
-
-    parts = ref.split("-")
+# get the data of a backend as an iterator over its chapters
+#
+# Backends that provide iterData are consumed while they are still
+# downloading. For all others, the list returned by getData is used.
+# The chapters are dicts of book, chapter and content, or Chapter
+# objects (see helper_chapter), which is what the dicts become anyway.
 
-    parts0 = parts[0].split(" ")
-    parts1 = parts[1].split(" ")
+def iter_backend_data(mod, version, verbose):
 
-    book1 = " ".join(parts0[-1])
-    book2 = " ".join(parts1[-1])
+    if hasattr(mod, "iterData"):
+        return mod.iterData(version, verbose)
 
-    if book1 != book2:
-        return ref
-
-    chapter1 = parts0[-1].split(":")[0]
-    chapter2 = parts1[-1].split(":")[0]
-    verse1 = parts0.split(":")[1]
-    verse2 = parts1.split(":")[1]
-
-    if chapter1 != chapter2:
-        return f"{book1} {chapter1}:{verse1}={chapter2}:{verse2}"
-
-    return f"{book1} {chapter1}:{verse1}-{verse2}"
+    return iter(mod.getData(version, verbose))
 
 ##################################################################
 ##################################################################
-# replace placeholders for cross references with proper xml
+# replace placeholders for cross references and footnotes with proper xml
+#
+# Cross references look like |[|book|chapter|verse|references|]| and
+# footnotes like |||book|chapter|footnote|||. They are split out of the
+# text when a chapter is converted to a Chapter (see helper_chapter),
+# always within the text of a single title, verse or line. So a marker
+# that is not closed can't reach into the next element and break the
+# xml. The numbering of both starts over with every chapter, it is
+# kept in a MarkerState. The content of a marker is escaped before it
+# is turned into xml.
+
+class MarkerState:
+
+    def __init__(self):
+        # cross references are labelled a..z, then aa..az, ba..bz, ...
+        self.xref_book = ""
+        self.xref_chapter = ""
+        self.refletter = 97
+        self.prefix = -1
+        # footnotes are numbered
+        self.fn_book = "Genesis"
+        self.fn_chapter = "1"
+        self.fn_id = 1
+
+# the osisRef and the label of a single cross reference target. Many targets show up again and again.
+@functools.lru_cache(maxsize=16384)
+def xref_target(ref):
+    start, end = parse_reference(ref)
+    target = osis_ref(*start) if start == end else f"{osis_ref(*start)}-{osis_ref(*end)}"
+    return target, ref.strip()
+
+# "Gen.1.3" for (Genesis, 1, 3), without the chapter and verse where they are not given
+def osis_ref(book, chapter, verse):
+    return ".".join([book_osis_ids[book]] + [str(n) for n in (chapter, verse) if n is not None])
+
+@functools.lru_cache(maxsize=256)
+def osis_book(book):
+    return convert_bookname_to_osis(book)
+
+def make_xref(content, state):
+
+    # extract book name, chapter, and verse number from start of section
+    fields = content.split("|")
+    book = fields[0]
+    shortbook = osis_book(book)
+    chapter = fields[1]
+    verse = fields[2]
+
+    if book != state.xref_book or state.xref_chapter != chapter:
+        # this converts to lower case 'a'
+        state.refletter = 97
+        state.prefix = -1
+        state.xref_book = book
+        state.xref_chapter = chapter
+
+    prefix = state.prefix
+    refletter = state.refletter
+    label = f"{chr(prefix) if prefix > 0 else ''}{chr(refletter)}"
+
+    # get a list of all references
+    allrefs = list(filter(str.strip, fields[-1].split(",")))
+
+    # start of reference section, an entry for all references, and the end of the reference section
+    ret = [f'<note type="crossReference" n="{label}" osisID="{shortbook}.{chapter}.{verse}!crossReference.{label}">']
+    for i,r in enumerate(allrefs):
+        target, text = xref_target(r)
+        ret.append(f'{";" if i>0 else ""}<reference osisRef="{target}">{text}</reference>')
+    ret.append("</note>")
+
+    # go to the next letter, unless we reached the 'z', then start over with 'a'
+    if refletter == 122:
+        if prefix == -1:
+            prefix = 97
+        else:
+            prefix += 1
+    refletter = (97 if refletter == 122 else refletter+1)
 
-def make_xrefs(text):
+    if prefix > 122:
+        print("ERROR: More cross references received than expected... this need to be fixed in the code!")
+        print("Resetting prefix to 97.")
+        prefix = 97
 
-    # no cross references -> nothing to do
-    if "|[|" not in text:
-        return text
+    state.prefix = prefix
+    state.refletter = refletter
 
-    # split along start of cross references
-    parts = text.split("|[|")
+    return "".join(ret)
 
-    # what came before is unchanged
-    ret = parts[0]
+# we keep italic and bold markers
+footnote_tag_pattern = re.compile(r"&lt;(/?)([ib])&gt;")
 
-    prevbook = ""
-    prevchapter = ""
+# the italic and bold tags of a footnote are only restored if they are properly nested
+def restore_footnote_tags(footnote):
 
-    # iterate through parts
-    for p in parts[1:]:
+    if "&lt;" not in footnote:
+        return footnote
 
-        # split along end of cross reference section
-        pp = p.split("|]|")
+    open_tags = []
+    for m in footnote_tag_pattern.finditer(footnote):
+        if m.group(1) == "":
+            open_tags.append(m.group(2))
+        elif not open_tags or open_tags.pop() != m.group(2):
+            return footnote
+    if open_tags:
+        return footnote
 
-        # extract book name, chapter, and verse number from start of section
-        book = pp[0].split("|")[0]
-        shortbook = convert_bookname_to_osis(book)
-        chapter = pp[0].split("|")[1]
-        verse = pp[0].split("|")[2]
+    return footnote_tag_pattern.sub(r"<\1\2>", footnote)
 
-        if book != prevbook or prevchapter != chapter:
-            # this converts to lower case 'a'
-            refletter = 97
-            prefix = -1
-            prevbook = book
-            prevchapter = chapter
+def make_footnote(content, state):
 
-        # get a list of all references
-        allrefs = list(filter(str.strip, pp[0].split("|")[-1].split(",")))
+    fields = content.split("|")
+    book = fields[0]
+    chapter = fields[1]
+    footnote = fields[2]
 
-        # start of reference section
-        ret += f'<note type="crossReference" n="{chr(prefix) if prefix > 0 else ""}{chr(refletter)}" osisID="{shortbook}.{chapter}.{verse}!crossReference.{chr(prefix) if prefix > 0 else ""}{chr(refletter)}">'
-        # add an entry for all references
-        for i,r in enumerate(allrefs):
-            ret += f'{";" if i>0 else ""}<reference osisRef="{condense_reference_ranges(convert_bookname_to_osis(r)).replace(" ",".").replace(":",".")}">{condense_reference_ranges(r.strip())}</reference>'
-        # end of reference section
-        ret += "</note>"
+    if book != state.fn_book or chapter != state.fn_chapter:
+        state.fn_book = book
+        state.fn_chapter = chapter
+        state.fn_id = 1
 
-        # go to the next letter, unless we reached the 'z', then start over with 'a'
-        if refletter == 122:
-            if prefix == -1:
-                prefix = 97
-            else:
-                prefix += 1
-        refletter = (97 if refletter == 122 else refletter+1)
+    footnote = restore_footnote_tags(footnote)
 
-        if prefix > 122:
-            print("ERROR: More cross references received than expected... this need to be fixed in the code!")
-            print("Resetting prefix to 97.")
-            prefix = 97
+    ret = f'<note type="explanation" n="{state.fn_id}">{footnote}</note>'
 
-        # the part that came after the end of the cross reference section is kept unchanged
-        ret += pp[1]
+    state.fn_id += 1
 
     return ret
 
 
 ##################################################################
 ##################################################################
-# replace placeholders for footnotes with proper xml
+# helpers for writing the OSIS xml file
+#
+# The xml is written as text, indented by two spaces per level. Text
+# is escaped the same way xml.dom.minidom does it, and characters that
+# are not allowed in xml at all are dropped. Together with the markers
+# (see above) this makes the xml well-formed by construction, it does
+# not need to be parsed again to be sure.
+
+invalid_xml_pattern = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+def escape_xml(text):
+    return invalid_xml_pattern.sub("", text).replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+# the start of an opening tag with all its attributes (but without the closing '>')
+def xml_tag(tag, attrs):
+    return "<" + tag + "".join(f' {k}="{escape_xml(v)}"' for k, v in attrs.items())
+
+# an element that only contains text (or nothing at all)
+def xml_text_element(level, tag, attrs, text):
+    return xml_inline_element(level, tag, attrs, [escape_xml(text)] if text else [])
+
+# an element that contains text and notes, which are already rendered to xml
+def xml_inline_element(level, tag, attrs, parts):
+    if parts:
+        return f"{'  '*level}{xml_tag(tag, attrs)}>{''.join(parts)}</{tag}>\n"
+    return f"{'  '*level}{xml_tag(tag, attrs)}/>\n"
+
+# an element with child elements, which are already rendered to text
+def xml_element(level, tag, attrs, children):
+    if children:
+        return f"{'  '*level}{xml_tag(tag, attrs)}>\n{''.join(children)}{'  '*level}</{tag}>\n"
+    return f"{'  '*level}{xml_tag(tag, attrs)}/>\n"
 
-def make_footnotes(text):
-
-    # no footnotes -> nothing to do
-    if "|||" not in text:
-        return text
+##################################################################
+##################################################################
+# generate the xml of a single chapter (a Chapter, or a chapter in
+# the format of the backends)
+
+def render_chapter(entry, shortbook):
+
+    chapter = Chapter.from_entry(entry)
+    kinds, values = chapter.kinds, chapter.values
+    count = len(kinds)
+    state = MarkerState()
+
+    # the xml of the text (and notes) starting at record i, and the record after it
+    def inline(i):
+        parts = []
+        while i < count and kinds[i] >= TEXT:
+            kind = kinds[i]
+            if kind == TEXT:
+                parts.append(escape_xml(values[i]))
+            elif kind == XREF:
+                parts.append(make_xref(escape_xml(values[i]), state))
+            else:
+                parts.append(make_footnote(escape_xml(values[i]), state))
+            i += 1
+        return parts, i
 
-    # split along footnotes delimiter (both start and end use same delimiter)
-    parts = text.split("|||")
+    # the rendered children of the chapter element, and the ones of the current section
+    chapter_items = []
+    section = None
+    i = 0
 
-    # what comes before the first footnote is kept unchanged
-    ret = parts[0]
+    while i < count:
 
-    fn_id = 1
+        kind = kinds[i]
+        value = values[i]
+        i += 1
 
-    prevbook = "Genesis"
-    prevchapter = "1"
+        if kind == SECTION:
+            section = []
+            chapter_items.append(section)
 
-    # loop through all parts in steps of two (as the start and end have the same delimiter)
-    for i in range(1,len(parts), 2):
+        elif kind == CHAPTER_TITLE:
+            parts, i = inline(i)
+            chapter_items.append(xml_inline_element(4, "title", {"type": "chapter"}, parts))
 
-        # we keep italic and bold markers
-        pp = parts[i]
+        elif kind == SECTION_TITLE:
+            parts, i = inline(i)
+            section.append(xml_inline_element(5, "title", {"type": "section"}, parts))
 
-        book = pp.split("|")[0]
-        chapter = pp.split("|")[1]
-        footnote = pp.split("|")[2]
+        elif kind == VERSE:
+            parts, i = inline(i)
+            section.append(xml_inline_element(5, "verse", {"osisID": f"{shortbook}.{chapter.chapter}.{value}"}, parts))
 
-        if book != prevbook or chapter != prevchapter:
-            prevbook = book
-            prevchapter = chapter
-            fn_id = 1
+        elif kind == POETRY:
+            lines = []
+            while i < count and kinds[i] == LINE:
+                parts, next_record = inline(i + 1)
+                lines.append(xml_inline_element(7, "l", {"level": str(values[i])}, parts))
+                i = next_record
+            section.append(xml_element(5, "verse", {"osisID": f"{shortbook}.{chapter.chapter}.{value}"}, [xml_element(6, "lg", {}, lines)]))
 
-        toreplace = {"&lt;i&gt;" : "<i>",
-                     "&lt;/i&gt;" : "</i>",
-                     "&lt;b&gt;" : "<b>",
-                     "&lt;/b&gt;" : "</b>"}
-        for t in toreplace:
-            footnote = footnote.replace(t, toreplace[t])
+    # the sections are rendered last, once all their children are known
+    chapter_items = [xml_element(4, "div", {"type": "section"}, item) if type(item) == list else item for item in chapter_items]
 
-        # add footnote
-        ret += f'<note type="explanation" n="{fn_id}">{footnote}</note>'
-        # and add everything after the end of the footnote unchanged
-        ret += parts[i+1]
+    return xml_element(3, "chapter", {"osisID": f"{shortbook}.{chapter.chapter}"}, chapter_items)
 
-        fn_id += 1
+# rendered chapters are cached with this stamp, it changes whenever the code rendering them does
+RENDER_STAMP = source_stamp(__file__, Path(__file__).parent / "helper_booknames.py", Path(__file__).parent / "helper_chapter.py")
 
-    return ret
+# the digest of the content of a chapter, as delivered by the backend
+def chapter_digest(entry):
+    if isinstance(entry, Chapter):
+        return digest_of(json.dumps([entry.book, entry.chapter, entry.kinds.tolist(), entry.values], ensure_ascii=False, separators=(",", ":")).encode())
+    return digest_of(json.dumps([entry['book'], entry['chapter'], entry['content']], ensure_ascii=False, separators=(",", ":")).encode())
 
+# render the given chapters of a book, this runs in the processes of the pool
+def render_chapters(entries, shortbook):
+    return [render_chapter(entry, shortbook) for entry in entries]
 
 ##################################################################
 ##################################################################
 # generate OSIS xml file
-
-def create_osis(data, name, path, verbose):
+#
+# The books are rendered independently of each other, on the process
+# pool in settings["process_pool"] if there is one. A book is handed
+# to the pool as soon as all its chapters arrived, and the books are
+# written in their order as soon as they are rendered, so only a few
+# books are ever held in memory as xml. Chapters found in the given
+# fragment cache are not rendered again. The digests of all chapters
+# are returned by their OSIS id.
+#
+# With 'check', the structure of the xml is checked while it is
+# written (see helper_osis). All errors found are printed and a
+# ValueError is raised at the end.
+
+def create_osis(data, name, path, verbose, fragments=None, check=False):
 
     # namespace handle
     name_space = "http://www.bibletechnologies.net/2003/OSIS/namespace"
 
-    # start XML element tree
-    EleTree.register_namespace('', name_space)
-
-    # create OSIS tags
-    osis = EleTree.Element(f"{{{name_space}}}osis")
-    text = EleTree.SubElement(osis, f"{{{name_space}}}osisText",
-                         {"osisIDWork": name, "osisRefWork": "Bible"})
-
-    # create header and work sub elements
-    header = EleTree.SubElement(text, f"{{{name_space}}}header")
-    work = EleTree.SubElement(header, f"{{{name_space}}}work", {"osisWork": name})
-
-    # store name as work text
-    EleTree.SubElement(work, f"{{{name_space}}}title").text = name
-
-    prevbook = ""
-
-    # loop over all data
-    for entry in data:
-
-        if entry == "Info":
-            continue
-
-        book = entry['book']
-        shortbook = convert_bookname_to_osis(book)
-        chapter = entry['chapter']
-
-        if book != prevbook:
-
-            # create new book sub element
-            bdiv = EleTree.SubElement(text, f"{{{name_space}}}div",
-                                {"type": "book", "osisID": shortbook})
-
-            prevbook = book
-
-        # create chapter sub element
-        cdiv = EleTree.SubElement(bdiv, f"{{{name_space}}}chapter",
-                                {"osisID": f"{shortbook}.{chapter}"})
-
-        in_section = False
-
-        for c in entry['content']:
+    checker = OsisChecker() if check else None
 
-            first = (c[0] if type(c) == list else c).lstrip()
-            second = (c[1] if type(c) == list else "").lstrip()
+    with open(path, "w", encoding="utf-8") as out:
 
-            if first == "":
-                continue
-
-            # new section
-            if first == "---":
-
-                csec = EleTree.SubElement(cdiv, f"{{{name_space}}}div",
-                                {"type": "section"})
-                in_section = True
-
-                continue
-
-            if first.startswith("## "):
+        def write(text):
+            out.write(text)
+            if checker:
+                checker.feed(text)
 
-                title = EleTree.SubElement(cdiv, f"{{{name_space}}}title",
-                                           {"type": "chapter"})
-                title.text = first.split("# ")[1].strip()
+        # create OSIS tags, the header, and the work sub elements (with the name as work text)
+        write('<?xml version="1.0" ?>\n')
+        write(f"{xml_tag('osis', {'xmlns': name_space})}>\n")
+        write(f"  {xml_tag('osisText', {'osisIDWork': name, 'osisRefWork': 'Bible'})}>\n")
+        write(xml_element(2, "header", {}, [xml_element(3, "work", {"osisWork": name}, [xml_text_element(4, "title", {}, name)])]))
 
-                csec = EleTree.SubElement(cdiv, f"{{{name_space}}}div",
-                                            {"type": "section"})
-                in_section = True
-
-                continue
+        chapters = {}
 
-            # create title
-            elif first.startswith("#"):
-
-                if not in_section:
-                    csec = EleTree.SubElement(cdiv, f"{{{name_space}}}div",
-                                                {"type": "section"})
-                    in_section = True
-
-                title = EleTree.SubElement(csec, f"{{{name_space}}}title",
-                                           {"type": "section"})
-                title.text = first.split("# ")[1].strip()
-
-                continue
-
-            if not in_section:
-                csec = EleTree.SubElement(cdiv, f"{{{name_space}}}div",
-                                            {"type": "section"})
-                in_section = True
-
-            # no verse data -> skip
-            if second == "":
-                continue
-
-            # create verse sub element
-            verse = EleTree.SubElement(csec, f"{{{name_space}}}verse",
-                                    {"osisID": f"{shortbook}.{chapter}.{first}"})
-
-            # poetry:
-            if "\n" in second:
-
-                parts = second.lstrip("\n").split("\n")
-
-                poetry = EleTree.SubElement(verse, f"{{{name_space}}}lg")
-
-                for p in parts:
-
-                    if p.strip() == "":
-                        continue
-
-                    level = math.ceil((len(p) - len(p.lstrip(' ')))/4)
-
-                    poetryline = EleTree.SubElement(poetry, f"{{{name_space}}}l",
-                                                    {"level": str(level)})
-                    poetryline.text = p.strip()
+        pool = settings["process_pool"]
+        # the books being rendered, in their order: the OSIS id, the chapters (digest and entry),
+        # the cached xml of the chapters (None where it has to be rendered), and the rendering job
+        books = deque()
 
+        def submit_book(shortbook, entries):
+            xml = [fragments.get(digest, RENDER_STAMP) if fragments else None for digest, entry in entries]
+            todo = [entry for (digest, entry), x in zip(entries, xml) if x is None]
+            if pool and todo:
+                job = pool.submit(render_chapters, todo, shortbook)
             else:
+                job = Future()
+                job.set_result(render_chapters(todo, shortbook))
+            books.append((shortbook, entries, xml, job))
+
+        def write_book(shortbook, entries, xml, job):
+            rendered = iter(job.result())
+            write(f"    {xml_tag('div', {'type': 'book', 'osisID': shortbook})}>\n")
+            for (digest, entry), x in zip(entries, xml):
+                if x is None:
+                    x = next(rendered)
+                    if fragments:
+                        fragments.put(digest, RENDER_STAMP, x)
+                write(x)
+            write("    </div>\n")
+
+        prevbook = ""
+        entries = []
+
+        # loop over all data
+        for entry in data:
+
+            if entry == "Info":
+                continue
 
-                # store plain verse text
-                verse.text = second
-
-    # create pretty xml from our string
-    xml = minidom.parseString(EleTree.tostring(osis, encoding="utf-8")).toprettyxml(indent="  ")
-
-    # format cross references and footnotes
-    # we do that AFTER prettying the XML above to keep its formatting unchanged
-    xml = make_xrefs(xml)
-    xml = make_footnotes(xml)
-
-    # store xml file
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(xml)
-
-
-##################################################################
-##################################################################
-# validate the xml to be sure
-
-def validate_xml(path, verbose):
-
-    from lxml import etree
-
-    # if the parsing fails, then it is invalid XML
-    try:
-        etree.parse(path)
+            # the chapter is kept in the compact form until its book is rendered
+            digest = chapter_digest(entry)
+            chapter = Chapter.from_entry(entry)
+            book = chapter.book
+
+            if book != prevbook:
+
+                # the previous book is complete
+                if entries:
+                    submit_book(shortbook, entries)
+                    # write the books that are done, or wait for the first one if too many are pending
+                    while books and (books[0][3].done() or len(books) > 2*settings["processes"]):
+                        write_book(*books.popleft())
+
+                prevbook = book
+                shortbook = convert_bookname_to_osis(book)
+                entries = []
+
+            chapters[f"{shortbook}.{chapter.chapter}"] = digest
+            entries.append((digest, chapter))
+
+        if entries:
+            submit_book(shortbook, entries)
+        while books:
+            write_book(*books.popleft())
+
+        write("  </osisText>\n")
+        write("</osis>\n")
+
+    if checker:
+        errors = checker.close()
+        if errors:
+            print("  OSIS structure errors:")
+            for e in errors[:20]:
+                print(f"   {e}")
+            if len(errors) > 20:
+                print(f"   ... and {len(errors)-20} more")
+            raise ValueError(f"The OSIS file of {name} has {len(errors)} structure errors")
         if verbose:
-            print("  XML structure valid.")
-    except etree.XMLSyntaxError as e:
-        print("  XML validation error:")
-        print(e)
-        raise
+            print("  OSIS structure valid.")
+
+    return chapters
 
 
 ##################################################################
 ##################################################################
 # build module and install it in the right folder structure
 
-def build_and_install(name, longname, language, osis_path, description, author, verbose):
+def build_and_install(name, longname, language, osis_path, description, author, verbose, install_root=Path("./build_temp")):
 
     # we create the file structure in a temp directory
-    install_root = Path("./build_temp")
+    install_root = Path(install_root)
 
     # the modules and mods.d directories
     module_path = install_root / "modules" / "texts" / "ztext" / name.lower()
@@ -356,10 +435,7 @@ def build_and_install(name, longname, language, osis_path, description, author,
     shutil.copyfile(osis_path, xml_d / f"{name}.xml")
 
     # Compile module with `osis2mod`
-    cmd = ["osis2mod", str(module_path), str(osis_path), "-z"]
-    if verbose:
-        print("  Running:", " ".join(cmd))
-    subprocess.run(cmd, check=True, capture_output=True)
+    compile_module(name, osis_path, module_path, verbose)
 
     # Create conf
     conf = f"""[{longname}]
@@ -384,46 +460,112 @@ TextSource={author}
 
 ##################################################################
 ##################################################################
-# pack zip module file
-def create_zip_module(name, root_dir, preserve_xml, verbose):
+# compile the OSIS file with osis2mod
+#
+# The compiled module is kept in the compile cache by the digest of
+# the OSIS file and the version of osis2mod, the same OSIS file is
+# never compiled twice. The output of osis2mod is streamed into a log
+# file of the module (cache/builds/<name>/osis2mod.log).
+
+# the version of osis2mod, None if it is not installed
+@functools.lru_cache(maxsize=None)
+def osis2mod_version():
+
+    # without arguments, osis2mod prints its version and how to use it
+    try:
+        result = subprocess.run(["osis2mod"], capture_output=True, text=True, errors="replace")
+    except OSError:
+        return None
 
-    import zipfile
+    output = result.stdout + result.stderr
+    for line in output.splitlines():
+        if "$Rev" in line or "SWORD" in line:
+            return line.strip()
+    return digest_of(output.encode())
 
-    zip_path = Path("output/")
-    zip_path.mkdir(exist_ok=True)
+# run a command, its output (stdout and stderr) is written to the log file line by line as it comes
+async def run_logged(cmd, log, verbose):
+
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
 
-    # handler for the zip file
-    zf = zipfile.ZipFile(zip_path / f"{name}.zip", "w")
+    with open(log, "wb") as f:
+        async for line in process.stdout:
+            f.write(line)
+            if verbose:
+                print("   ", line.decode(errors="replace").rstrip())
+
+    return await process.wait()
+
+def compile_module(name, osis_path, module_path, verbose):
+
+    version = osis2mod_version()
+    cached = compiled_path(digest_of(f"{file_digest(osis_path)}|{version}".encode())) if version else None
+
+    if cached and cached.is_dir():
+        if verbose:
+            print("  The OSIS file was compiled before, using that module.")
+        shutil.copytree(cached, module_path, dirs_exist_ok=True)
+        return
+
+    cmd = ["osis2mod", str(module_path), str(osis_path), "-z"]
+    if verbose:
+        print("  Running:", " ".join(cmd))
+
+    log = build_path(name) / "osis2mod.log"
+    log.parent.mkdir(parents=True, exist_ok=True)
+    returncode = asyncio.run(run_logged(cmd, log, verbose))
+    if returncode != 0:
+        print(f"  osis2mod failed, see '{log}'")
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+    if cached:
+        # copied under another name first, so a half-copied module is never used
+        tmp = cached.with_name(f"{cached.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copytree(module_path, tmp)
+        try:
+            tmp.rename(cached)
+        except OSError:
+            # another build stored the same module in the meantime
+            shutil.rmtree(tmp)
+
+##################################################################
+##################################################################
+# pack zip module file
+#
+# The zip file is written to a temporary file first, which then replaces
+# the old one, so there never is a half-written module in the output
+# directory. If a file object is given, the zip file is written to it
+# instead (it doesn't have to be seekable).
 
-    # we descend down into where the root of the zip file is supposed to be
+def create_zip_module(name, root_dir, preserve_xml, verbose, fileobj=None):
+
+    # the names in the zip file are relative to the root dir,
     # without that we will have additional root folders we don't want
-    # we store the cwd to go back to where we came from at the end
-    curcwd = os.getcwd()
-    os.chdir(root_dir)
-
-    # add the .conf file from the modules subdir
-    for dirname, subdirs, files in os.walk("modules"):
-        zf.write(dirname)
-        for filename in files:
-            zf.write(os.path.join(dirname, filename))
-    # add the compiled text files from the mods.d subdir
-    for dirname, subdirs, files in os.walk("mods.d"):
-        zf.write(dirname)
-        for filename in files:
-            zf.write(os.path.join(dirname, filename))
+    # (we don't change into the root dir, as other builds might be running at the same time)
+    # the modules subdir has the compiled text files, the mods.d subdir the .conf file
+    subdirs = ["modules", "mods.d"]
     if preserve_xml:
         if verbose:
             print("  Presering XML file.")
         # add the xml file for safekeeping
-        for dirname, subdirs, files in os.walk("xml"):
-            zf.write(dirname)
-            for filename in files:
-                zf.write(os.path.join(dirname, filename))
+        subdirs.append("xml")
+
+    entries = zip_entries(root_dir, subdirs)
 
-    # done
-    zf.close()
-    # and go back to where we started
-    os.chdir(curcwd)
+    if fileobj is not None:
+        write_zip(fileobj, entries, settings["processes"])
+        return
+
+    zip_path = Path("output/")
+    zip_path.mkdir(exist_ok=True)
+
+    tmp = zip_path / f".{name}.zip.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            write_zip(f, entries, settings["processes"])
+        tmp.replace(zip_path / f"{name}.zip")
+    finally:
+        tmp.unlink(missing_ok=True)
 
     print(f"  -> Module was created at '{zip_path / f"{name}.zip"}'")
 
@@ -437,33 +579,100 @@ def generate_module(name, content,
                     description,
                     author,
                     preserve_xml,
-                    verbose):
+                    verbose,
+                    build_dir=None):
+
+    # create temporary build directory, every build gets its own unless one is given
+    if build_dir is None:
+        Path("./build_temp").mkdir(exist_ok=True)
+        build_dir = Path(tempfile.mkdtemp(prefix=f"{name}.", dir="./build_temp"))
+    else:
+        build_dir = Path(build_dir)
+        if build_dir.exists():
+            shutil.rmtree(build_dir)
+        build_dir.mkdir(parents=True, exist_ok=True)
 
-    # create temporary build directory
-    build_dir = Path("./build_temp")
-    if build_dir.exists():
-        shutil.rmtree(build_dir)
-    build_dir.mkdir(exist_ok=True)
+    try:
+        build_module(name, content, longname, language, description, author, preserve_xml, verbose, build_dir)
+    finally:
+        if verbose:
+            print(" Cleaning up temporary files...")
+        shutil.rmtree(build_dir, ignore_errors=True)
+        # the build_temp directory is removed once no build uses it anymore
+        try:
+            build_dir.parent.rmdir()
+        except OSError:
+            pass
+
+# the stages of a build, in the given build directory
+def build_module(name, content, longname, language, description, author, preserve_xml, verbose, build_dir):
+
+    # what the last build of this module was made of (nothing for a full rebuild)
+    manifest = load_build_manifest(name) if settings["incremental"] else {}
+    fragments = open_fragment_cache() if settings["incremental"] else None
 
     # here we build the XML file
     osis_path = build_dir / f"{name}.osis.xml"
 
+    # The processes render the books of the OSIS file (and parse the downloaded pages in the backends
+    # that do that). They are created before the backend starts any downloading thread. The builds of
+    # a batch share their processes.
+    own_pool = settings["process_pool"] is None and settings["processes"] > 1
+    if own_pool:
+        settings["process_pool"] = create_process_pool(settings["processes"])
+
     if verbose:
         print(" Creating OSIS...")
-    create_osis(content, name, osis_path, verbose)
+    try:
+        chapters = create_osis(content, name, osis_path, verbose, fragments, settings["check_osis"])
+    finally:
+        if own_pool and settings["process_pool"]:
+            settings["process_pool"].shutdown(cancel_futures=True)
+            settings["process_pool"] = None
+    osis_digest = file_digest(osis_path)
 
-    if verbose:
-        print(" Validating XML...")
-    validate_xml(str(osis_path), verbose)
+    if manifest:
+        report_changes(manifest.get("chapters", {}), chapters)
 
-    if verbose:
-        print(" Building + Installing to temporary directory...")
-    build_and_install(name, longname, language, osis_path, description, author, verbose)
+    new_manifest = {"chapters": chapters, "osis": osis_digest}
 
-    if verbose:
-        print(" Creating ZIP module file...")
-    create_zip_module(name, build_dir, preserve_xml, verbose)
+    # the zip file is only made again if anything that goes into it changed
+    zip_file = Path("output") / f"{name}.zip"
+    zipped = {"input": digest_of("|".join([osis_digest, str(osis2mod_version()), name, longname, language, description, author, str(preserve_xml)]).encode())}
 
-    if verbose:
-        print(" Cleaning up temporary files...")
-    shutil.rmtree(build_dir)
+    if manifest.get("zip", {}).get("input") == zipped["input"] and zip_file.exists() and file_digest(zip_file) == manifest["zip"].get("output"):
+        if verbose:
+            print(" Module is unchanged, skipping build and ZIP file.")
+        print(f"  -> Module is unchanged at '{zip_file}'")
+        zipped["output"] = manifest["zip"]["output"]
+
+    else:
+        if verbose:
+            print(" Building + Installing to temporary directory...")
+        build_and_install(name, longname, language, osis_path, description, author, verbose, build_dir)
+
+        if verbose:
+            print(" Creating ZIP module file...")
+        create_zip_module(name, build_dir, preserve_xml, verbose)
+        zipped["output"] = file_digest(zip_file)
+
+    new_manifest["zip"] = zipped
+    save_build_manifest(name, new_manifest)
+
+# print which chapters changed since the last build
+def report_changes(before, after):
+
+    changed = [c for c in after if before.get(c) != after[c]]
+    removed = [c for c in before if c not in after]
+
+    if not changed and not removed:
+        print("  No chapters changed since the last build.")
+        return
+
+    def listed(ids):
+        return ", ".join(ids[:10]) + (f" and {len(ids)-10} more" if len(ids) > 10 else "")
+
+    if changed:
+        print(f"  {len(changed)} chapters changed since the last build: {listed(changed)}")
+    if removed:
+        print(f"  {len(removed)} chapters were removed since the last build: {listed(removed)}")
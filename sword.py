@@ -1,6 +1,9 @@
 import argparse
 import textwrap
 from modules.worker import *
+from modules.helper_general import settings, print_rate_metrics
+from modules.helper_cache import migrate_cache
+from modules.batch import read_manifest, parse_jobs, run_batch
 
 ########################################################################
 ########################################################################
@@ -14,7 +17,26 @@ parser.add_argument('--backend', default="", help=f"Automatically choose the spe
 parser.add_argument('--bible-version', default="", help="Automatically choose the specified bible version.")
 parser.add_argument('--confirm-rights', default=False, action='store_true', help="Don't ask whether I have the required permissions.")
 parser.add_argument('--available-versions', default=False, action='store_true', help="List all bible versions that are supported for the given backend.")
+parser.add_argument('--language', default=None, help="Only list the bible versions of this language (e.g. en, or eng for aolab) with --available-versions.")
 parser.add_argument('--preserve-xml', default=False, action='store_true', help="Preserve the XML in the final module file.")
+parser.add_argument('--workers', default=settings["workers"], type=int, help=f"Maximum number of parallel downloads (default: {settings['workers']}).")
+parser.add_argument('--processes', default=settings["processes"], type=int, help=f"Number of processes used for parsing downloaded pages (default: {settings['processes']}).")
+parser.add_argument('--whole-book', default=False, action='store_true', help="Request whole books at once instead of single chapters (if supported by the backend).")
+parser.add_argument('--chapters-per-request', default=0, type=int, help="Limit the number of chapters requested at once in whole-book mode (default: no limit).")
+parser.add_argument('--cache-store', default=settings["cache_store"], choices=["pack", "loose"], help="Store downloaded pages in one compressed file per version (pack) or in one file per page (loose).")
+parser.add_argument('--migrate-cache', default=False, action='store_true', help="Move all cached pages from the loose layout into pack files and exit. A build does this by itself for the versions it needs.")
+parser.add_argument('--rate-limit', default=settings["rate_limit"], type=float, help=f"Maximum number of requests per second to the same server, the actual rate adapts to the server (default: {settings['rate_limit']}).")
+parser.add_argument('--max-per-host', default=settings["max_per_host"], type=int, help=f"Maximum number of parallel requests to the same server, over all builds (default: {settings['max_per_host']}).")
+parser.add_argument('--refresh', default=False, action='store_true', help="Check all cached pages with the server and download the ones that changed.")
+parser.add_argument('--cache-ttl', default=None, type=float, help="Number of days after which cached pages are checked with the server again (default: depends on the backend).")
+parser.add_argument('--no-bulk', default=False, action='store_true', help="Always download chapter by chapter, even where a backend can download whole translations at once.")
+parser.add_argument('--check-osis', default=False, action='store_true', help="Check the structure of the generated OSIS file (verse order, duplicate ids, unclosed notes) while it is written.")
+parser.add_argument('--html-parser', default=settings["html_parser"], choices=["lxml", "bs4"], help="Parse downloaded pages with lxml (fast, the default if it is installed) or with BeautifulSoup.")
+parser.add_argument('--compare-parsers', default=False, action='store_true', help="Parse all cached pages of the chosen version with both HTML parsers and report the pages with different results.")
+parser.add_argument('--full-rebuild', default=False, action='store_true', help="Build the module from scratch, without reusing anything from the last build.")
+parser.add_argument('--batch', default="", help="Build several modules at once, given as a comma separated list of backend:version (e.g. aolab:BSB,biblegateway:KJV). Versions can be glob patterns like aolab:eng*.")
+parser.add_argument('--batch-file', default="", help="Build all modules listed in the given file, one backend:version per line.")
+parser.add_argument('--jobs', default=2, type=int, help="Number of modules built at the same time in batch mode (default: 2).")
 
 args = parser.parse_args()
 
@@ -25,6 +47,20 @@ arg_confirmrights = args.confirm_rights
 arg_verbose = args.verbose
 arg_preserve_xml = args.preserve_xml
 
+settings["workers"] = max(1, args.workers)
+settings["rate_limit"] = args.rate_limit
+settings["processes"] = args.processes
+settings["whole_book"] = args.whole_book
+settings["chapters_per_request"] = max(0, args.chapters_per_request)
+settings["cache_store"] = args.cache_store
+settings["max_per_host"] = max(1, args.max_per_host)
+settings["incremental"] = not args.full_rebuild
+settings["refresh"] = args.refresh
+settings["bulk"] = not args.no_bulk
+settings["check_osis"] = args.check_osis
+settings["html_parser"] = args.html_parser
+settings["cache_ttl"] = args.cache_ttl*24*3600 if args.cache_ttl is not None else None
+
 ########################################################################
 
 print("")
@@ -35,6 +71,50 @@ print("")
 
 ########################################################################
 
+if args.migrate_cache:
+    print(" Moving cached pages into pack files...")
+    print("")
+    for b in backends:
+        m = load_backend(b)
+        if hasattr(m, "CACHE_LAYOUT"):
+            migrate_cache(b, m.CACHE_LAYOUT, arg_verbose)
+    print("")
+    print(" Done!")
+    print("")
+    exit()
+
+########################################################################
+
+if args.batch or args.batch_file:
+
+    specs = args.batch.split(",") if args.batch else []
+    try:
+        if args.batch_file:
+            specs += read_manifest(args.batch_file)
+        jobs = parse_jobs(specs)
+    except (ValueError, OSError) as e:
+        print(f" [Error] {e}")
+        print("")
+        exit(1)
+
+    if not arg_confirmrights:
+        print(" Batch builds don't ask for confirmation. Please confirm with --confirm-rights that you either have")
+        print(" the right to or have obtained permission to make a digital copy of all requested bible versions.")
+        print("")
+        exit(1)
+
+    print(f" Building {len(jobs)} modules, {max(1, args.jobs)} at a time...")
+    print("")
+
+    status = run_batch(jobs, args.jobs, arg_preserve_xml, arg_verbose)
+
+    print("")
+    print(" Done!")
+    print("")
+    exit(0 if all(job["status"] == "done" for job in status) else 1)
+
+########################################################################
+
 if arg_backend == "":
     print("")
     print("First choose which backend to use:")
@@ -60,7 +140,7 @@ if arg_backend == "":
 
     arg_backend = backends[arg_backend]
 
-    mod = __import__(f'modules.backend_{arg_backend.replace(".","")}', fromlist=[''])
+    mod = load_backend(arg_backend)
 
 else:
 
@@ -70,7 +150,7 @@ else:
         exit()
 
 print(f"      Using backend: {arg_backend}")
-mod = __import__(f'modules.backend_{arg_backend.replace(".","")}', fromlist=[''])
+mod = load_backend(arg_backend)
 desc = textwrap.fill(mod.getDescription(), 75)
 [print(f"{' '*21}{l}") for l in desc.split("\n")]
 print("")
@@ -81,9 +161,11 @@ all_versions = mod.getSupportedVersions()
 
 if arg_listsupported:
 
+    listed = mod.getSupportedVersions(args.language) if args.language else all_versions
+
     print(f" The supported bible versions of the backend '{arg_backend}' are:")
     print("")
-    [print(f"{ver:>12} | {all_versions[ver][0]} ({all_versions[ver][1]})") for ver in all_versions]
+    [print(f"{ver:>12} | {listed[ver][0]} ({listed[ver][1]})") for ver in listed]
     print("")
 
     exit()
@@ -134,6 +216,21 @@ print(f" Requesting Version: {arg_version} ({all_versions[arg_version][0]})")
 
 ########################################################################
 
+if args.compare_parsers:
+
+    if not hasattr(mod, "compareParsers"):
+        print(f" The backend '{arg_backend}' does not parse HTML pages, there is nothing to compare.")
+        print("")
+        exit()
+
+    print(" Comparing the HTML parsers on the cached pages...")
+    print("")
+    same = mod.compareParsers(arg_version, arg_verbose)
+    print("")
+    exit(0 if same else 1)
+
+########################################################################
+
 if not arg_confirmrights:
     print("")
     print("Depending on where you live, you might not have the automatic right to a digital version\n"
@@ -166,16 +263,14 @@ print("")
 
 ########################################################################
 
-print(" Launching download. This might take a little while...")
+print(" Launching download. The module is generated while the download is running.")
+print(" This might take a little while...")
 print("")
 
-data = mod.getData(arg_version, arg_verbose)
+data = iter_backend_data(mod, arg_version, arg_verbose)
 
 ########################################################################
 
-print("")
-print(" Download completed! Generating module...")
-
 generate_module(name=f"{arg_version}_{arg_backend.replace(".","")}",
                 content=data,
                 longname=all_versions[arg_version][0],
@@ -185,6 +280,11 @@ generate_module(name=f"{arg_version}_{arg_backend.replace(".","")}",
                 preserve_xml=arg_preserve_xml,
                 verbose=arg_verbose)
 
+if arg_verbose:
+    print("")
+    print(" Servers:")
+    print_rate_metrics()
+
 ########################################################################
 
 print("")